@@ -5,7 +5,7 @@ import logging
 from . import api
 
 
-def create_app():
+def create_app(db=None, auth=None):
     app = Flask(__name__,
                 static_url_path='',
                 static_folder='../ui/build',
@@ -19,6 +19,6 @@ def create_app():
     CORS(app, resources={r'/api/*': {"origins": ["http://localhost:3000", "http://localhost"]}})
     app.config['CORS_HEADERS'] = 'Content-Type'
 
-    api.init(app)
+    api.init(app, db, auth)
 
     return app
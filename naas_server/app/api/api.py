@@ -1,7 +1,14 @@
 import os
+import time
+import hashlib
+import hmac
+import json
+import queue
+import secrets
 import logging
-from . import zoom, classes, utils, gitlab, gcp
-from flask import request
+from datetime import datetime
+from . import zoom, classes, utils, gitlab, gcp, cache, callbacks, catalog, events, jobs, latency, metrics, profiles, quota, stats, workers, zoom_tokens, warm_pool as pool, scheduler as session_scheduler
+from flask import Response, g, request
 from flask_apscheduler import APScheduler
 import firebase_admin
 from firebase_admin import auth as firebase_auth, credentials as firebase_credentials, firestore
@@ -11,8 +18,94 @@ from firebase_admin import auth as firebase_auth, credentials as firebase_creden
 # to 'true'. The tag to use in production is 'uselive'.
 IMAGE_TAG = os.environ.get('IMAGE_TAG', 'uselive')
 
-
-def init(app):
+# The image chosen for each tag is cached, see gcp.IMAGE_CACHE_TTL. Publishing
+# an image drops the cache with a request carrying IMAGE_CACHE_SECRET in the
+# x-narupa-image-cache-secret header; without the secret, the cache expires on
+# its own only.
+IMAGE_CACHE_SECRET = os.environ.get('IMAGE_CACHE_SECRET')
+
+# The scheduler handles sessions concurrently, with at most
+# SCHEDULER_CONCURRENCY sessions in flight. Sessions not started within
+# SCHEDULER_TICK_DEADLINE seconds are left for later. Sessions are handled when
+# they are due, and every SCHEDULER_RECONCILE_MINUTES all the active sessions
+# are read again from Firestore.
+SCHEDULER_CONCURRENCY = int(os.environ.get('NARUPA_SCHEDULER_CONCURRENCY', 16))
+SCHEDULER_TICK_DEADLINE = int(os.environ.get('NARUPA_SCHEDULER_TICK_DEADLINE', 50))
+SCHEDULER_RECONCILE_MINUTES = int(os.environ.get('NARUPA_SCHEDULER_RECONCILE_MINUTES', 15))
+
+# Optional pool of idle instances, as a list of region=size pairs such as
+# 'europe-west3=2,us-east1=1'. See warm_pool.WarmPool.
+WARM_POOL_SIZES = pool.parse_sizes(os.environ.get('NARUPA_WARM_POOL'))
+
+# Simulation instances report when they are ready or stopped to
+# NARUPA_CALLBACK_URL, the public URL of this API, with a token signed with
+# NARUPA_CALLBACK_SECRET. Without them, the scheduler only polls.
+CALLBACK_URL = os.environ.get('NARUPA_CALLBACK_URL')
+CALLBACK_SECRET = os.environ.get('NARUPA_CALLBACK_SECRET')
+
+# Verified ID tokens are cached until they expire, for at most TOKEN_CACHE_TTL
+# seconds. Users are cached by firebase_uid, and dropped whenever they are
+# written by this process.
+TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL', 300))
+TOKEN_CACHE_SIZE = 10000
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))
+USER_CACHE_SIZE = 1000
+
+# Calls to Zoom run in the background as jobs, see jobs.JobQueue, kept in the
+# Firestore jobs collection or, with JOB_STORE=memory, in each process alone.
+# Every JOB_POLL_INTERVAL seconds, each process runs the jobs that are due,
+# JOB_CONCURRENCY at a time.
+JOB_STORE = os.environ.get('JOB_STORE', 'firestore')
+JOB_CONCURRENCY = int(os.environ.get('JOB_CONCURRENCY', 4))
+JOB_POLL_INTERVAL = int(os.environ.get('JOB_POLL_INTERVAL', 10))
+
+# The checks of a new session that call other services, such as GitLab, run
+# concurrently, CHECK_CONCURRENCY at a time across requests, and the request
+# fails if they have not all returned within CHECK_DEADLINE seconds.
+CHECK_CONCURRENCY = int(os.environ.get('CHECK_CONCURRENCY', 16))
+CHECK_DEADLINE = float(os.environ.get('CHECK_DEADLINE', 10))
+
+# Connections following the events of a session are sent a comment every
+# EVENTS_KEEP_ALIVE seconds so that proxies keep them open, and closed after
+# EVENTS_MAX_SECONDS, after which browsers connect again by themselves. Each
+# holds a gunicorn thread, so at most EVENTS_MAX_STREAMS are open at once per
+# process, leaving the other threads to the rest of the API.
+EVENTS_KEEP_ALIVE = 15
+EVENTS_MAX_SECONDS = int(os.environ.get('EVENTS_MAX_SECONDS', 5 * 60))
+EVENTS_MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 16))
+
+# EventSource cannot send the ID token as a header, and a token in the URL
+# would end up in access logs. It connects instead with a ticket for one
+# session, signed with EVENTS_SECRET and valid for EVENTS_TICKET_TTL seconds.
+# Without EVENTS_SECRET, tickets only work with the process that issued them.
+EVENTS_SECRET = os.environ.get('EVENTS_SECRET') or secrets.token_hex(32)
+EVENTS_TICKET_TTL = int(os.environ.get('EVENTS_TICKET_TTL', 10 * 60))
+
+SESSIONS_PAGE_SIZE = 50
+SESSIONS_MAX_PAGE_SIZE = 200
+
+
+def init(app, db=None, auth=None):
+    """
+    Set up the routes and jobs of the API. `db` and `auth` stand for the
+    Firestore client and the firebase_admin.auth module, and default to the
+    real ones; the benchmarks give fakes instead.
+    """
+    if db is None:
+        firebase_admin.initialize_app(firebase_credentials.Certificate(os.environ.get('FIREBASE_CREDENTIALS_PATH')))
+        db = firestore.client()
+    db = metrics.instrument_firestore(db)
+    auth = auth or firebase_auth
+    warm_pool = pool.WarmPool(pool.ComputeBackend(IMAGE_TAG), WARM_POOL_SIZES, app.logger) if WARM_POOL_SIZES else None
+    boot_latency = latency.BootLatencyEstimator(db.collection('boot_latency'), app.logger)
+    usage = stats.UsageStats(db, app.logger)
+    quotas = quota.MonthlyQuota(db, app.logger)
+    narupa = session_scheduler.NarupaScheduler(
+        db, app.logger, IMAGE_TAG, SCHEDULER_CONCURRENCY, SCHEDULER_TICK_DEADLINE,
+        warm_pool=warm_pool, boot_latency=boot_latency, callback_url=CALLBACK_URL, callback_secret=CALLBACK_SECRET,
+        usage=usage, quota=quotas)
+    job_store = jobs.MemoryJobStore() if JOB_STORE == 'memory' else jobs.FirestoreJobStore(db)
+    job_queue = jobs.JobQueue(job_store, app.logger, JOB_CONCURRENCY, JOB_POLL_INTERVAL)
 
     scheduler = APScheduler()
     if (not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true') and os.environ.get('NARUPA_SCHEDULER'):
@@ -20,36 +113,114 @@ def init(app):
         scheduler.api_enabled = True
         scheduler.start()
         logging.getLogger('apscheduler').setLevel(logging.WARNING)
-
-    firebase_admin.initialize_app(firebase_credentials.Certificate(os.environ.get('FIREBASE_CREDENTIALS_PATH')))
-    db = firestore.client()
+        narupa.start()
+    if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        job_queue.start()
+
+    checks = workers.WorkerPool(CHECK_CONCURRENCY, name='narupa-checks')
+    branches = gitlab.BranchCache(gitlab.NARUPA_PROJECT_ID)
+    session_events = events.SessionEvents(db.collection('sessions'), app.logger, EVENTS_MAX_STREAMS)
+    zoom_refresher = zoom_tokens.ZoomTokenRefresher(db, app.logger, on_change=lambda user: forget_user(user))
+    token_cache = cache.TTLCache(TOKEN_CACHE_TTL, maxsize=TOKEN_CACHE_SIZE)
+    user_cache = cache.TTLCache(USER_CACHE_TTL, maxsize=USER_CACHE_SIZE)
+    simulations = catalog.SimulationCatalog()
+    simulations.bootstrap(db.collection('simulations'))
+    simulations.watch(db.collection('simulations'))
+
+    @app.before_request
+    def start_timer():
+        g.request_started_at = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        if 'request_started_at' in g:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            metrics.observe_request(request.method, route, response.status_code, time.perf_counter() - g.request_started_at)
+        return response
+
+    @app.route('/metrics')
+    def get_metrics():
+        body, content_type = metrics.export()
+        return body, 200, {'Content-Type': content_type}
+
+    @app.errorhandler(utils.ValidationError)
+    def validation_error(e):
+        return bad_request(str(e))
 
     @app.route('/test/images')
     def list_images():
-        return str(gcp.choose_image(IMAGE_TAG))
+        return {'image': gcp.choose_image(IMAGE_TAG), 'cache': gcp.image_cache_stats()}
+
+    @app.route('/test/images/cache', methods=['DELETE'])
+    def invalidate_images():
+        secret = request.headers.get('x-narupa-image-cache-secret')
+        if not IMAGE_CACHE_SECRET or not secret or not hmac.compare_digest(secret, IMAGE_CACHE_SECRET):
+            return unauthorized()
+        gcp.invalidate_image_cache(request.args.get('tag'))
+        return no_content()
 
-    @scheduler.task('cron', id='narupa_scheduler', minute='*')
+    @scheduler.task('cron', id='narupa_scheduler', minute='*/{}'.format(SCHEDULER_RECONCILE_MINUTES))
     @app.route('/api/narupa-scheduler')
     def narupa_scheduler():
-        docs = db.collection('sessions').where('instance.status', 'in', ['LAUNCHED', 'WARMING', 'PENDING']).stream()
-        for doc in docs:
-            try:
-                session = classes.Session(doc)
-                if session.instance.status == 'PENDING':
-                    warm_up(session)
-                elif session.instance.status == 'WARMING':
-                    warm_up_check(session)
-                elif session.instance.status == 'LAUNCHED':
-                    launched_check(session)
-            except Exception as e:
-                app.logger.warning('Unable to run scheduled task on session: {}, with error: {}'.format(doc.id, e))
-                app.logger.exception(e)
-
+        narupa.tick()
         return no_content()
 
+    @scheduler.task('interval', id='warm_pool', minutes=1)
+    def refill_warm_pool():
+        try:
+            narupa.refill_warm_pool()
+        except Exception as e:
+            app.logger.warning('Unable to refill the warm pool: {}'.format(e))
+
+    @scheduler.task('interval', id='zoom_tokens', seconds=zoom_tokens.REFRESH_INTERVAL)
+    def refresh_zoom_tokens():
+        try:
+            zoom_refresher.refresh_expiring()
+        except Exception as e:
+            app.logger.warning('Unable to refresh Zoom tokens: {}'.format(e))
+
+    @app.route('/test/warm-pool')
+    def get_warm_pool():
+        return {'regions': warm_pool.stats() if warm_pool is not None else {}}
+
+    @app.route('/test/placement')
+    def get_placement():
+        return {'zones': gcp.zone_placement.stats()}
+
+    @app.route('/api/boot-latency')
+    def get_boot_latency():
+        user = get_user_from_request(request)
+        if user is None:
+            return unauthorized()
+
+        return {'items': boot_latency.estimates(IMAGE_TAG, utils.DEFAULT_WARM_UP_LEAD)}
+
+    @app.route('/api/branches')
+    def get_branches():
+        user = get_user_from_request(request)
+        if user is None:
+            return unauthorized()
+
+        try:
+            return {'items': branches.names()}
+        except RuntimeError as e:
+            app.logger.warning('Unable to get branches: {}'.format(e))
+            return service_unavailable('Unable to list branches')
+
+    @app.route('/api/stats')
+    def get_stats():
+        user = get_user_from_request(request)
+        if user is None:
+            return unauthorized()
+
+        if not user.can_view_stats:
+            return bad_request('You do not have permission to view stats')
+
+        return usage.rollup(request.args.get('from'), request.args.get('to', usage.today()))
+
     @app.route('/api/users', methods=['POST'])
     def create_user():
-        data = utils.pick(request.json, classes.User.public_fields)
+        data = utils.pick(request.json, classes.User.public_fields, classes.User.types)
         user = classes.User(data)
         db_document('users', user.id).set(user.to_dict())
         return user.to_dict()
@@ -71,19 +242,75 @@ def init(app):
         zoom_redirect_uri = request.json['zoom_redirect_uri']
         user.zoom = zoom.init_zoom_tokens(zoom_authorization_code, zoom_redirect_uri)
         db_document('users', user.id).set(user.to_dict())
+        forget_user(user)
         return no_content()
 
+    @app.route('/api/users/me/quota')
+    def get_users_me_quota():
+        user = get_user_from_request(request)
+        if user is None:
+            return unauthorized()
+
+        month = request.args.get('month', utils.now_in_timezone('UTC')[:7])
+        try:
+            datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            return bad_request('Invalid month')
+        return quotas.usage(user, month)
+
     @app.route('/api/sessions')
     def get_sessions():
         user = get_user_from_request(request)
         if user is None:
             return unauthorized()
 
+        try:
+            limit = int(request.args.get('limit', SESSIONS_PAGE_SIZE))
+        except ValueError:
+            return bad_request('Invalid limit')
+        if not 1 <= limit <= SESSIONS_MAX_PAGE_SIZE:
+            return bad_request('Invalid limit')
+
+        fields = request.args.get('fields')
+        if fields is not None:
+            fields = [field for field in fields.split(',') if field and field != 'id']
+            if any(field not in classes.Session.fields for field in fields):
+                return bad_request('Invalid fields')
+
+        query = db.collection('sessions').where('user_id', '==', user.id)
+
+        # As in the UI, a session is past once it has ended, so sessions in
+        # progress are upcoming. Firestore orders a range filter by its field
+        # first, hence the order by end time when filtering.
+        time_filter = request.args.get('filter')
+        if time_filter is not None:
+            if time_filter not in ['upcoming', 'past']:
+                return bad_request('Invalid filter')
+            now = utils.now_in_timezone('UTC')
+            query = query.where('end_at_utc', '>=' if time_filter == 'upcoming' else '<', now)
+            query = query.order_by('end_at_utc', direction=firestore.Query.DESCENDING)
+        else:
+            query = query.order_by('start_at', direction=firestore.Query.DESCENDING)
+
+        cursor = request.args.get('cursor')
+        if cursor:
+            cursor_doc = db_document('sessions', cursor).get()
+            if not cursor_doc.exists:
+                return bad_request('Invalid cursor')
+            query = query.start_after(cursor_doc)
+
+        if fields is not None:
+            query = query.select(fields)
+
         sessions = []
-        docs = db.collection('sessions').where('user_id', '==', user.id).order_by('start_at', direction=firestore.Query.DESCENDING).stream()
-        for doc in docs:
-            sessions.append(classes.Session(doc).to_dict())
-        return {'items': sessions}
+        for doc in query.limit(limit).stream():
+            if fields is None:
+                sessions.append(classes.Session(doc).to_dict())
+            else:
+                sessions.append({'id': doc.id, **(doc.to_dict() or {})})
+
+        next_cursor = sessions[-1]['id'] if len(sessions) == limit else None
+        return {'items': sessions, 'next_cursor': next_cursor}
 
     @app.route('/api/sessions/<session_id>')
     def get_session(session_id):
@@ -98,6 +325,56 @@ def init(app):
 
         return session.to_dict()
 
+    @app.route('/api/sessions/<session_id>/events/ticket', methods=['POST'])
+    def create_session_events_ticket(session_id):
+        user = get_user_from_request(request)
+        if user is None:
+            return unauthorized()
+
+        doc = db_document('sessions', session_id).get()
+        if not doc.exists:
+            return not_found()
+        if classes.Session(doc).user_id != user.id:
+            return unauthorized()
+
+        ticket = events.sign_ticket(EVENTS_SECRET, session_id, time.time() + EVENTS_TICKET_TTL)
+        return {'ticket': ticket, 'expires_in': EVENTS_TICKET_TTL}
+
+    @app.route('/api/sessions/<session_id>/events')
+    def get_session_events(session_id):
+        """
+        Server-sent events with the instance of a session whenever it changes,
+        for the holder of a ticket from create_session_events_ticket, given as
+        the ticket query parameter.
+        """
+        if not events.verify_ticket(EVENTS_SECRET, session_id, request.args.get('ticket'), time.time()):
+            return unauthorized()
+
+        followed = session_events.subscribe(session_id)
+        if followed is None:
+            return service_unavailable('Too many open event streams')
+
+        def stream():
+            try:
+                yield 'retry: {}\n\n'.format(EVENTS_KEEP_ALIVE * 1000)
+                closes_at = time.monotonic() + EVENTS_MAX_SECONDS
+                while time.monotonic() < closes_at:
+                    try:
+                        event = followed.get(timeout=min(EVENTS_KEEP_ALIVE, max(closes_at - time.monotonic(), 0)))
+                    except queue.Empty:
+                        yield ': keep-alive\n\n'
+                        continue
+                    yield 'event: instance\ndata: {}\n\n'.format(json.dumps(event))
+                    if event['deleted']:
+                        return
+            finally:
+                session_events.unsubscribe(session_id, followed)
+
+        response = Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # In case the stream is closed before it started.
+        response.call_on_close(lambda: session_events.unsubscribe(session_id, followed))
+        return response
+
     @app.route('/api/sessions', methods=['POST'])
     def create_session():
         user = get_user_from_request(request)
@@ -105,7 +382,7 @@ def init(app):
             return unauthorized()
 
         body = request.json
-        session = classes.Session(utils.pick(body, classes.Session.public_fields))
+        session = classes.Session(utils.pick(body, classes.Session.public_fields, classes.Session.types))
         session.user_id = user.id
 
         if not session.location:
@@ -114,23 +391,41 @@ def init(app):
         if utils.difference_in_minutes(session.start_at, session.end_at) > 300:
             return bad_request('Session is longer than 5 hour limit')
 
-        if not gitlab.has_branch('11262591', session.branch):
-            return bad_request('Invalid branch')
+        def check_branch():
+            if not branches.has_branch(session.branch):
+                raise utils.ValidationError('Invalid branch')
 
-        simulation = db_document('simulations', body['simulation']['id']).get()
-        if not simulation.exists:
-            return bad_request('Invalid simulation')
-        session.simulation = classes.Simulation(simulation)
+        def check_simulation():
+            simulation = find_simulation(body['simulation']['id'])
+            if simulation is None:
+                raise utils.ValidationError('Invalid simulation')
+            return simulation
 
-        session.warm_up_at = utils.generate_warm_up_at(session)
+        timings = {}
+        try:
+            results = checks.gather({'branch': check_branch, 'simulation': check_simulation}, CHECK_DEADLINE, timings)
+        except TimeoutError as e:
+            app.logger.warning('Unable to check session: {}, with error: {}'.format(session.id, e))
+            return service_unavailable('Timed out checking the session')
+        finally:
+            app.logger.info('Checked session: {} in {}'.format(
+                session.id, ', '.join('{} {:.0f} ms'.format(name, seconds * 1000) for name, seconds in sorted(timings.items()))))
+        session.simulation = results['simulation']
 
-        refresh_zoom_tokens(user)
-        if session.create_conference and user.has_zoom():
-            zoom_meeting = zoom.create_meeting(user, session)
-            if zoom_meeting:
-                session.zoom_meeting = zoom_meeting
+        session.end_at_utc = utils.to_utc(session.end_at, session.timezone)
+        session.warm_up_at = generate_warm_up_at(session)
+
+        quotas.reserve(user, session)
+
+        try:
+            db_document('sessions', session.id).set(session.to_dict())
+        except Exception:
+            quotas.release(session)
+            raise
+        narupa.schedule(session)
 
-        db_document('sessions', session.id).set(session.to_dict())
+        if session.create_conference and user.has_zoom():
+            job_queue.enqueue('zoom_create', 'zoom_create:{}'.format(session.id), {'user_id': user.id, 'session_id': session.id})
 
         return session.to_dict()
 
@@ -145,16 +440,21 @@ def init(app):
         if session.user_id != user.id:
             return unauthorized()
 
-        updates = utils.pick(request.json, classes.Session.public_fields)
+        updates = utils.pick(request.json, classes.Session.public_fields, classes.Session.types)
+        if session.instance.status in session_scheduler.ACTIVE_STATUSES:
+            quotas.update(user, session, classes.Session.from_dict({**session.to_dict(), **updates}, session.id))
         doc.update(updates)
         session = classes.Session(doc.get())
 
-        session.warm_up_at = utils.generate_warm_up_at(session)
-        doc.set(session.to_dict())
+        session.end_at_utc = utils.to_utc(session.end_at, session.timezone)
+        session.warm_up_at = generate_warm_up_at(session)
+        doc.update({'warm_up_at': session.warm_up_at, 'end_at_utc': session.end_at_utc})
+        narupa.schedule(session)
 
-        refresh_zoom_tokens(user)
-        if session.zoom_meeting and user.has_zoom():
-            zoom.update_meeting(user, session)
+        # The meeting of a new session may still be in the making; its job
+        # reads the session when it runs, so it gets the update either way.
+        if (session.zoom_meeting or session.create_conference) and user.has_zoom():
+            job_queue.enqueue('zoom_update', 'zoom_update:{}'.format(session.id), {'user_id': user.id, 'session_id': session.id})
 
         return no_content()
 
@@ -170,10 +470,21 @@ def init(app):
             return unauthorized()
 
         doc.delete()
+        narupa.forget(session.id)
+        if session.instance.status == 'PENDING':
+            quotas.release(session)
+        elif session.instance.status in ['WARMING', 'LAUNCHED']:
+            # The instance would otherwise run until the end of the session,
+            # beyond the minutes booked for it.
+            try:
+                gcp.delete_instance(session.location, session.instance.id, session.instance.zone)
+            except Exception as e:
+                app.logger.warning('Unable to delete instance for session: {}, with error: {}'.format(session.id, e))
+            usage.session_stopped(session)
+            quotas.reconcile(session)
 
-        refresh_zoom_tokens(user)
         if session.zoom_meeting and user.has_zoom():
-            zoom.delete_meeting(user, session)
+            job_queue.enqueue('zoom_delete', 'zoom_delete:{}'.format(session.id), {'user_id': user.id, 'meeting_id': session.zoom_meeting.id})
 
         return no_content()
 
@@ -189,14 +500,104 @@ def init(app):
             return unauthorized()
 
         try:
-            gcp.delete_instance(session.location, session.instance.id)
+            gcp.delete_instance(session.location, session.instance.id, session.instance.zone)
         except Exception as e:
             app.logger.warning('Unable to delete instance for session: {}, with error: {}'.format(doc.id, e))
 
+        was_running = session.instance.status in ['WARMING', 'LAUNCHED']
         session.instance.status = 'STOPPED'
         session.instance.ip = None
 
-        doc.set(session.to_dict())
+        doc.update({'instance': session.instance.to_dict()})
+        narupa.forget(session.id)
+        if was_running:
+            usage.session_stopped(session)
+            quotas.reconcile(session)
+
+        return no_content()
+
+    @job_queue.handler('zoom_create')
+    def create_zoom_meeting(payload):
+        user = find_zoom_user(payload['user_id'])
+        doc = db_document('sessions', payload['session_id'])
+        snapshot = doc.get()
+        if user is None or not snapshot.exists:
+            return
+        session = classes.Session(snapshot)
+        if session.zoom_meeting:
+            return
+
+        zoom_meeting = zoom.create_meeting(user, session)
+        if zoom_meeting is None:
+            raise RuntimeError('Zoom did not create the meeting')
+        try:
+            doc.update({'zoom_meeting': zoom_meeting.to_dict()})
+        except Exception:
+            # Most likely the session was deleted meanwhile.
+            zoom.delete_meeting(user, classes.Session.from_dict({'zoom_meeting': zoom_meeting.to_dict()}))
+            raise
+
+    @job_queue.handler('zoom_update')
+    def update_zoom_meeting(payload):
+        user = find_zoom_user(payload['user_id'])
+        snapshot = db_document('sessions', payload['session_id']).get()
+        if user is None or not snapshot.exists:
+            return
+        session = classes.Session(snapshot)
+        if not session.zoom_meeting:
+            return
+
+        if zoom.update_meeting(user, session) is None:
+            raise RuntimeError('Zoom did not update the meeting')
+
+    @job_queue.handler('zoom_delete')
+    def delete_zoom_meeting(payload):
+        user = find_zoom_user(payload['user_id'])
+        if user is None:
+            return
+
+        # The session is gone by now; only the id of its meeting is needed.
+        if not zoom.delete_meeting(user, classes.Session.from_dict({'zoom_meeting': {'id': payload['meeting_id']}})):
+            raise RuntimeError('Zoom did not delete the meeting')
+
+    @job_queue.handler('inspect_simulation')
+    def inspect_simulation(payload):
+        """
+        Record the size of a simulation, which decides the machine it runs on.
+        """
+        doc = db_document('simulations', payload['simulation_id'])
+        snapshot = doc.get()
+        if not snapshot.exists:
+            return
+        simulation = classes.Simulation(snapshot)
+
+        found = profiles.inspect(simulation)
+        doc.update(found)
+        simulations.put(classes.Simulation.from_dict({**simulation.to_dict(), **found}, simulation.id))
+
+    @app.route('/api/sessions/<session_id>/callback', methods=['POST'])
+    def session_callback(session_id):
+        if not narupa.has_callbacks():
+            return not_found()
+
+        body = request.json or {}
+        if not callbacks.verify(CALLBACK_SECRET, session_id, body.get('token')):
+            return unauthorized()
+
+        doc = db_document('sessions', session_id).get()
+        if not doc.exists:
+            return not_found()
+
+        session = classes.Session(doc)
+        if session.instance.id != body.get('instance'):
+            return bad_request('Instance is not the one of the session')
+
+        if body.get('status') == 'ready':
+            narupa.instance_ready(session, body.get('ip') or request.remote_addr)
+        elif body.get('status') == 'stopped':
+            narupa.instance_stopped(session)
+        else:
+            return bad_request('Invalid status')
 
         return no_content()
 
@@ -206,14 +607,7 @@ def init(app):
         if user is None:
             return unauthorized()
 
-        simulations = []
-        docs = db.collection('simulations').order_by('name', direction=firestore.Query.ASCENDING).stream()
-        for doc in docs:
-            simulation = classes.Simulation(doc)
-            if simulation.public or simulation.user_id == user.id:
-                simulations.append(simulation.to_dict())
-
-        return {'items': simulations}
+        return {'items': [simulation.to_dict() for simulation in simulations.visible_to(user.id)]}
 
     @app.route('/api/simulations/<simulation_id>')
     def get_simulation(simulation_id):
@@ -235,7 +629,7 @@ def init(app):
         if user is None:
             return unauthorized()
 
-        simulation = classes.Simulation(utils.pick(request.json, classes.Simulation.public_fields))
+        simulation = classes.Simulation(utils.pick(request.json, classes.Simulation.public_fields, classes.Simulation.types))
         simulation.user_id = user.id
 
         if not simulation.name:
@@ -247,7 +641,12 @@ def init(app):
         if simulation.public and not user.can_make_simulations_public:
             return bad_request('You do not have permission to make this simulation public')
 
+        if simulation.machine_profile and simulation.machine_profile not in profiles.PROFILES:
+            return bad_request('Invalid machine profile')
+
         db_document('simulations', simulation.id).set(simulation.to_dict())
+        simulations.put(simulation)
+        enqueue_inspection(simulation.id)
         return simulation.to_dict()
 
     @app.route('/api/simulations/<simulation_id>', methods=['PUT'])
@@ -261,12 +660,22 @@ def init(app):
         if simulation.user_id != user.id:
             return bad_request('You do not have permission to update this simulation')
 
-        updates = utils.pick(request.json, classes.Simulation.public_fields)
+        updates = utils.pick(request.json, classes.Simulation.public_fields, classes.Simulation.types)
 
         if updates['public'] and not user.can_make_simulations_public:
             return bad_request('You do not have permission to make this simulation public')
 
+        if updates['machine_profile'] and updates['machine_profile'] not in profiles.PROFILES:
+            return bad_request('Invalid machine profile')
+
+        files_changed = any(updates[key] != getattr(simulation, key) for key in ['runner', 'config_url', 'topology_url', 'trajectory_url'])
+        if files_changed:
+            updates.update({'particle_count': None, 'trajectory_size': None})
+
         db_document('simulations', simulation_id).update(updates)
+        simulations.put(classes.Simulation.from_dict({**simulation.to_dict(), **updates}, simulation_id))
+        if files_changed:
+            enqueue_inspection(simulation_id)
         return no_content()
 
     @app.route('/api/simulations/<simulation_id>', methods=['DELETE'])
@@ -280,6 +689,7 @@ def init(app):
             return bad_request('You do not have permission to update this simulation')
 
         db_document('simulations', simulation_id).delete()
+        simulations.remove(simulation_id)
         return no_content()
 
     @app.route('/', defaults={'path': ''})
@@ -290,16 +700,22 @@ def init(app):
         return app.send_static_file(f)
 
     def get_user_from_request(req):
-        if 'x-narupa-id-token' not in req.headers:
+        id_token = req.headers.get('x-narupa-id-token')
+        if not id_token:
             return None
 
         try:
-            id_token = req.headers['x-narupa-id-token']
-            decoded_token = firebase_auth.verify_id_token(id_token)
+            decoded_token = verify_id_token(id_token)
             uid = decoded_token['uid']
-            docs = db.collection('users').where('firebase_uid', '==', uid).stream()
+            user = user_cache.get(uid)
+            if user is not None:
+                return user
+
+            docs = db.collection('users').where('firebase_uid', '==', uid).limit(1).stream()
             for doc in docs:
-                return classes.User(doc)
+                user = classes.User(doc)
+                user_cache.set(uid, user)
+                return user
             
             app.logger.info('No user found with firebase_ui: {}'.format(uid))
             return None
@@ -307,6 +723,65 @@ def init(app):
             app.logger.warning('Unable to get user from request: {}'.format(e))
             return None
 
+    def verify_id_token(id_token):
+        key = hashlib.sha256(id_token.encode()).hexdigest()
+        decoded_token = token_cache.get(key)
+        if decoded_token is None:
+            decoded_token = auth.verify_id_token(id_token)
+            ttl = min(TOKEN_CACHE_TTL, decoded_token['exp'] - time.time())
+            if ttl > 0:
+                token_cache.set(key, decoded_token, ttl=ttl)
+        return decoded_token
+
+    def forget_user(user):
+        user_cache.pop(user.firebase_uid)
+
+    def find_zoom_user(user_id):
+        """
+        The user with fresh Zoom tokens, or None if they have no Zoom account
+        linked anymore.
+        """
+        user = zoom_refresher.fresh_user(user_id)
+        return user if user is not None and user.has_zoom() else None
+
+    def find_simulation(simulation_id):
+        simulation = simulations.get(simulation_id)
+        if simulation is None:
+            doc = db_document('simulations', simulation_id).get()
+            if not doc.exists:
+                return None
+            simulation = classes.Simulation(doc)
+            simulations.put(simulation)
+        return simulation
+
+    def generate_warm_up_at(session):
+        runner = session.simulation.runner if session.simulation else None
+        lead = boot_latency.lead(session.location, IMAGE_TAG, runner, utils.DEFAULT_WARM_UP_LEAD)
+        if (warm_pool is not None and warm_pool.enabled(session.location) and session.branch == pool.POOL_BRANCH
+                and profiles.resolve(session.simulation).name == profiles.DEFAULT_PROFILE):
+            pool_warm_up_at = utils.to_timestamp(utils.generate_warm_up_at(session, pool.POOL_WARM_UP_LEAD), session.timezone)
+            competing = count_warming_sessions(session, pool_warm_up_at - warm_pool.horizon, pool_warm_up_at)
+            lead = warm_pool.warm_up_lead(session.location, session.branch, competing, lead)
+        return utils.generate_warm_up_at(session, lead)
+
+    def count_warming_sessions(session, start, end):
+        """
+        The other pending sessions of the region of `session` warming up
+        between the timestamps `start` and `end`.
+        """
+        query = db.collection('sessions').where('location', '==', session.location).where('instance.status', '==', 'PENDING')
+        count = 0
+        for doc in query.select(['warm_up_at', 'timezone']).stream():
+            data = doc.to_dict() or {}
+            if doc.id == session.id or not data.get('warm_up_at') or not data.get('timezone'):
+                continue
+            if start <= utils.to_timestamp(data['warm_up_at'], data['timezone']) <= end:
+                count += 1
+        return count
+
+    def enqueue_inspection(simulation_id):
+        job_queue.enqueue('inspect_simulation', 'inspect_simulation:{}'.format(simulation_id), {'simulation_id': simulation_id})
+
     def no_content():
         return '', 204
 
@@ -316,70 +791,11 @@ def init(app):
     def unauthorized():
         return {'message': 'Unauthorized'}, 401
 
-    def db_document(collection, document_id):
-        return db.collection(collection).document(document_id)
-
-    def refresh_zoom_tokens(user):
-        if user.has_zoom() and user.zoom.has_access_token_expired():
-            user.zoom = zoom.refresh_zoom_tokens(user)
-            user_doc = db_document('users', user.id)
-            user_doc.set(user.to_dict()) if user.has_zoom() else user_doc.update({'zoom': firestore.DELETE_FIELD})
-
-    def warm_up(session):
-        if session.has_warm_up_at_passed():
-            runner = session.simulation.runner
-            simulation = None
-            topology = None
-            trajectory = None
-            if runner == 'ase' or runner == 'omm':
-                simulation = session.simulation.config_url
-            elif runner == 'static':
-                topology = session.simulation.topology_url
-            elif runner == 'trajectory':
-                topology = session.simulation.topology_url
-                trajectory = session.simulation.trajectory_url
-
-            duration = int(utils.difference_in_seconds(session.warm_up_at, session.end_at))
-
-            try:
-                response = gcp.create_instance(
-                    IMAGE_TAG,
-                    session.location,
-                    session.branch,
-                    runner, duration,
-                    session.end_at,
-                    session.timezone,
-                    simulation=simulation,
-                    topology=topology,
-                    trajectory=trajectory,
-                )
-
-                if response['status'] in ['PROVISIONING', 'STAGING', 'RUNNING']:
-                    session.instance.status = 'WARMING'
-                    session.instance.id = response['instanceName']
-                else:
-                    app.logger.warning('Marking instance as failed in state: ' + response['status'])
-                    session.instance.status = 'FAILED'
-            except Exception as e:
-                app.logger.warning('Failed to create instance: {}'.format(e))
-                session.instance.status = 'FAILED'
-
-            db_document('sessions', session.id).set(session.to_dict())
+    def not_found():
+        return {'message': 'Not found'}, 404
 
-    def warm_up_check(session):
-        response = gcp.get_instance(session.location, session.instance.id)
-        if response['narupaStatus']:
-            session.instance.status = 'LAUNCHED'
-            session.instance.ip = response['instanceIp']
-            db_document('sessions', session.id).set(session.to_dict())
-        elif response['status'] not in ['PROVISIONING', 'STAGING', 'RUNNING']:
-            app.logger.warning('Marking instance as failed in state: ' + response['status'])
-            session.instance.status = 'FAILED'
-            db_document('sessions', session.id).set(session.to_dict())
+    def service_unavailable(message):
+        return {'message': message}, 503
 
-    def launched_check(session):
-        response = gcp.get_instance(session.location, session.instance.id)
-        if not response['narupaStatus']:
-            session.instance.status = 'STOPPED'
-            session.instance.ip = None
-            db_document('sessions', session.id).set(session.to_dict())
+    def db_document(collection, document_id):
+        return db.collection(collection).document(document_id)
@@ -0,0 +1,21 @@
+import hashlib
+import hmac
+
+
+def sign(secret, session_id):
+    return hmac.new(secret.encode(), session_id.encode(), hashlib.sha256).hexdigest()
+
+
+def verify(secret, session_id, token):
+    return bool(token) and hmac.compare_digest(sign(secret, session_id), token)
+
+
+def get_callback_metadata(base_url, secret, session_id):
+    """
+    The instance metadata telling a simulation instance where to report its
+    status, and the token proving the report comes from that session.
+    """
+    return [
+        { 'key': 'callback_url', 'value': '{}/api/sessions/{}/callback'.format(base_url.rstrip('/'), session_id) },
+        { 'key': 'callback_token', 'value': sign(secret, session_id) },
+    ]
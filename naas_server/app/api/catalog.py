@@ -0,0 +1,84 @@
+import threading
+from collections import defaultdict
+from . import classes
+
+
+class SimulationCatalog:
+    """
+    An in-memory copy of the simulations collection, indexed by owner and by
+    public flag.
+
+    The catalog is loaded once, then kept up to date by a Firestore snapshot
+    listener and by the writes made through this process.
+    """
+
+    def __init__(self):
+        self._simulations = {}
+        self._by_owner = defaultdict(set)
+        self._public = set()
+        self._lock = threading.Lock()
+        self._watch = None
+
+    def bootstrap(self, collection):
+        simulations = [classes.Simulation(doc) for doc in collection.stream()]
+        with self._lock:
+            self._simulations.clear()
+            self._by_owner.clear()
+            self._public.clear()
+            for simulation in simulations:
+                self._put(simulation)
+
+    def watch(self, collection):
+        self._watch = collection.on_snapshot(self._on_snapshot)
+
+    def unwatch(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def get(self, simulation_id):
+        with self._lock:
+            return self._simulations.get(simulation_id)
+
+    def visible_to(self, user_id):
+        """
+        The simulations a user can see, their own and the public ones, sorted
+        by name.
+        """
+        with self._lock:
+            ids = self._public | self._by_owner.get(user_id, set())
+            simulations = [self._simulations[simulation_id] for simulation_id in ids]
+        return sorted(simulations, key=lambda simulation: simulation.name or '')
+
+    def put(self, simulation):
+        with self._lock:
+            self._put(simulation)
+
+    def remove(self, simulation_id):
+        with self._lock:
+            self._remove(simulation_id)
+
+    def _put(self, simulation):
+        self._remove(simulation.id)
+        self._simulations[simulation.id] = simulation
+        self._by_owner[simulation.user_id].add(simulation.id)
+        if simulation.public:
+            self._public.add(simulation.id)
+
+    def _remove(self, simulation_id):
+        simulation = self._simulations.pop(simulation_id, None)
+        if simulation is None:
+            return
+        owned = self._by_owner.get(simulation.user_id)
+        if owned is not None:
+            owned.discard(simulation_id)
+            if not owned:
+                del self._by_owner[simulation.user_id]
+        self._public.discard(simulation_id)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        for change in changes:
+            if change.type.name == 'REMOVED':
+                self.remove(change.document.id)
+            else:
+                self.put(classes.Simulation(change.document))
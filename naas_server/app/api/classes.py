@@ -1,118 +1,209 @@
 from . import utils
 from datetime import datetime
-import pytz
 
 
-class Session:
-    public_fields = ['description', 'start_at', 'timezone', 'end_at', 'record', 'location', 'branch', 'create_conference']
+class ModelType(type):
+    """
+    Build a model class from its `schema`.
+
+    The schema is a list of (name, type, default) tuples. The type is either a
+    Python type, used to validate incoming values, another model, hydrated
+    from and serialized to a nested dictionary, or None. The default is a value
+    or a callable returning one.
+
+    The metaclass declares one slot per field, and compiles `_load` and
+    `to_dict` so that hydrating and serializing a document is a straight run
+    of attribute accesses rather than a reflective walk of the object.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        schema = namespace.get('schema', [])
+        namespace['__slots__'] = tuple(field for field, _, _ in schema)
+        cls = super().__new__(mcs, name, bases, namespace)
+        if schema:
+            cls.fields = [field for field, _, _ in schema]
+            cls.types = {field: kind for field, kind, _ in schema if kind is not None and not isinstance(kind, ModelType)}
+            cls._load = _compile_load(cls, schema, cls.identified)
+            cls.to_dict = _compile_to_dict(cls, schema)
+        return cls
+
+
+def _compile_load(cls, schema, identified):
+    lines = ['def _load(self, d, id):']
+    scope = {}
+    for i, (field, kind, default) in enumerate(schema):
+        if field == 'id' and identified:
+            lines.append('    self.id = id')
+            continue
+        scope['default_{}'.format(i)] = default
+        fallback = 'default_{}()'.format(i) if callable(default) else 'default_{}'.format(i)
+        if isinstance(kind, ModelType):
+            scope['model_{}'.format(i)] = kind
+            lines.append('    value = d.get({!r}, None)'.format(field))
+            lines.append('    self.{} = model_{}.from_dict(value) if value is not None else {}'.format(field, i, fallback))
+        else:
+            lines.append('    self.{0} = d[{0!r}] if {0!r} in d else {1}'.format(field, fallback))
+    return _compile(lines, scope, '_load', cls)
+
+
+def _compile_to_dict(cls, schema):
+    # Fields of nested models may be left unset, in which case they are left
+    # out of the dictionary.
+    lines = ['def to_dict(self):', '    data = {}']
+    for field, kind, _ in schema:
+        lines.append('    try:')
+        lines.append('        value = self.{}'.format(field))
+        lines.append('    except AttributeError:')
+        lines.append('        pass')
+        lines.append('    else:')
+        if isinstance(kind, ModelType):
+            lines.append('        data[{!r}] = value.to_dict() if value is not None else None'.format(field))
+        else:
+            lines.append('        data[{!r}] = value'.format(field))
+    lines.append('    return data')
+    return _compile(lines, {}, 'to_dict', cls)
+
+
+def _compile(lines, scope, name, cls):
+    code = compile('\n'.join(lines), '<{}.{}>'.format(cls.__name__, name), 'exec')
+    exec(code, scope)
+    return scope[name]
+
+
+class Document(metaclass=ModelType):
+    """
+    A model stored as its own Firestore document.
+
+    Documents are built either from a dictionary, in which case they get a new
+    id, or from a Firestore document snapshot.
+    """
+    identified = True
 
     def __init__(self, data):
-        d = data if utils.is_dict(data) else data.to_dict()
-        self.id = utils.generate_id() if utils.is_dict(data) else data.id
-        self.created_at = d.get('created_at', utils.generate_created_at())
-        self.user_id = d.get('user_id', None)
-        self.description = d.get('description', None)
-        self.warm_up_at = d.get('warm_up_at', None)
-        self.start_at = d.get('start_at', None)
-        self.end_at = d.get('end_at', None)
-        self.terminate_at = d.get('terminate_at', None)
-        self.timezone = d.get('timezone', None)
-        self.record = d.get('record', False)
-        self.create_conference = d.get('create_conference', False)
-        self.location = d.get('location', None)
-        self.branch = d.get('branch', None)
-        self.instance = Instance(d['instance']) if d.get('instance', None) is not None else Instance({'status': 'PENDING'})
-        self.simulation = Simulation(d['simulation']) if d.get('simulation', None) is not None else None
-        self.zoom_meeting = ZoomMeeting(d['zoom_meeting']) if d.get('zoom_meeting', None) is not None else None
-
-    def to_dict(self):
-        return utils.to_dict(self)
-
-    def has_warm_up_at_passed(self):
-        now = datetime.now(pytz.utc)
-        timezone = pytz.timezone(self.timezone)
-        when_naive = utils.to_datetime(self.warm_up_at)
-        when = timezone.localize(when_naive)
-
-        return now > when
-
-
-class User:
-    public_fields = ['name', 'email', 'firebase_uid']
-    
-    def __init__(self, data):
-        d = data if utils.is_dict(data) else data.to_dict()
-        self.id = utils.generate_id() if utils.is_dict(data) else data.id
-        self.created_at = d.get('created_at', utils.generate_created_at())
-        self.name = d.get('name', None)
-        self.email = d.get('email', None)
-        self.can_make_simulations_public = d.get('can_make_simulations_public', None)
-        self.can_view_stats = d.get('can_view_stats', None)
-        self.firebase_uid = d.get('firebase_uid', None)
-        # self.quota_hours_per_month = d.get('quota_hours_per_month', 5)
-        self.zoom = UserZoom(d['zoom']) if d.get('zoom', None) is not None else None
-
-    def to_dict(self):
-        return utils.to_dict(self)
-
-    def has_zoom(self):
-        return self.zoom and self.zoom.access_token
+        if utils.is_dict(data):
+            self._load(data, utils.generate_id())
+        else:
+            self._load(data.to_dict(), data.id)
+
+    @classmethod
+    def from_dict(cls, data, id=None):
+        """
+        Build a document from a dictionary, keeping the id it holds if any.
+        """
+        document = cls.__new__(cls)
+        document._load(data, id or data.get('id') or utils.generate_id())
+        return document
+
+
+class Embedded(metaclass=ModelType):
+    """
+    A model stored within a document. An empty model has no field set.
+    """
+    identified = False
 
-
-class Simulation:
-    public_fields = ['name', 'description', 'author', 'citation', 'image_url', 'runner', 'config_url', 'topology_url', 'trajectory_url', 'rendering_url', 'public']
-
-    def __init__(self, data):
-        d = data if utils.is_dict(data) else data.to_dict()
-        self.id = utils.generate_id() if utils.is_dict(data) else data.id
-        self.created_at = d.get('created_at', utils.generate_created_at())
-        self.user_id = d.get('user_id', None)
-        self.name = d.get('name', None)
-        self.description = d.get('description', None)
-        self.author = d.get('author', None)
-        self.citation = d.get('citation', None)
-        self.image_url = d.get('image_url', None)
-        self.runner = d.get('runner', None)
-        self.config_url = d.get('config_url', None)
-        self.topology_url = d.get('topology_url', None)
-        self.trajectory_url = d.get('trajectory_url', None)
-        self.rendering_url = d.get('rendering_url', None)
-        self.public = d.get('public', False)
-
-    def to_dict(self):
-        return utils.to_dict(self)
-
-
-class UserZoom:
     def __init__(self, data):
         if data:
-            self.access_token = data.get('access_token', None)
-            self.refresh_token = data.get('refresh_token', None)
-            self.access_token_expires_at = data.get('access_token_expires_at', None)
+            self._load(data, None)
 
-    def to_dict(self):
-        return utils.to_dict(self)
-
-    def has_access_token_expired(self):
-        return datetime.now() > utils.to_datetime(self.access_token_expires_at)
+    @classmethod
+    def from_dict(cls, data):
+        embedded = cls.__new__(cls)
+        if data:
+            embedded._load(data, None)
+        return embedded
 
 
-class ZoomMeeting:
-    def __init__(self, data):
-        if data:
-            self.id = data.get('id', None)
-            self.join_url = data.get('join_url', None)
+class UserZoom(Embedded):
+    schema = [
+        ('access_token', str, None),
+        ('refresh_token', str, None),
+        ('access_token_expires_at', str, None),
+    ]
 
-    def to_dict(self):
-        return utils.to_dict(self)
+    def has_access_token_expired(self):
+        return datetime.now() > utils.to_datetime(self.access_token_expires_at)
 
 
-class Instance:
-    def __init__(self, data):
-        if data:
-            self.status = data.get('status', None)  # PENDING, WARMING, LAUNCHED, FAILED, STOPPED
-            self.id = data.get('id', None)
-            self.ip = data.get('ip', None)
+class ZoomMeeting(Embedded):
+    schema = [
+        ('id', None, None),
+        ('join_url', str, None),
+    ]
+
+
+class Instance(Embedded):
+    schema = [
+        ('status', str, None),  # PENDING, WARMING, LAUNCHED, FAILED, STOPPED
+        ('id', str, None),
+        ('ip', str, None),
+        ('zone', str, None),
+        ('machine_profile', str, None),
+        ('gpu_count', int, None),
+        ('pooled', bool, False),
+        ('warming_at', str, None),  # UTC
+        ('launched_at', str, None),  # UTC
+    ]
+
+
+class Simulation(Document):
+    public_fields = ['name', 'description', 'author', 'citation', 'image_url', 'runner', 'config_url', 'topology_url', 'trajectory_url', 'rendering_url', 'public', 'machine_profile']
+    schema = [
+        ('id', str, None),
+        ('created_at', str, utils.generate_created_at),
+        ('user_id', str, None),
+        ('name', str, None),
+        ('description', str, None),
+        ('author', str, None),
+        ('citation', str, None),
+        ('image_url', str, None),
+        ('runner', str, None),
+        ('config_url', str, None),
+        ('topology_url', str, None),
+        ('trajectory_url', str, None),
+        ('rendering_url', str, None),
+        ('public', bool, False),
+        ('machine_profile', str, None),  # overrides the profile resolved by profiles.resolve
+        ('particle_count', int, None),
+        ('trajectory_size', int, None),  # bytes
+    ]
+
+
+class Session(Document):
+    public_fields = ['description', 'start_at', 'timezone', 'end_at', 'record', 'location', 'branch', 'create_conference']
+    schema = [
+        ('id', str, None),
+        ('created_at', str, utils.generate_created_at),
+        ('user_id', str, None),
+        ('description', str, None),
+        ('warm_up_at', str, None),
+        ('start_at', str, None),
+        ('end_at', str, None),
+        ('end_at_utc', str, None),  # end_at in UTC, for listing sessions by end time
+        ('terminate_at', str, None),
+        ('timezone', str, None),
+        ('record', bool, False),
+        ('create_conference', bool, False),
+        ('location', str, None),
+        ('branch', str, None),
+        ('instance', Instance, lambda: Instance({'status': 'PENDING'})),
+        ('simulation', Simulation, None),
+        ('zoom_meeting', ZoomMeeting, None),
+    ]
+
+
+class User(Document):
+    public_fields = ['name', 'email', 'firebase_uid']
+    schema = [
+        ('id', str, None),
+        ('created_at', str, utils.generate_created_at),
+        ('name', str, None),
+        ('email', str, None),
+        ('can_make_simulations_public', bool, None),
+        ('can_view_stats', bool, None),
+        ('firebase_uid', str, None),
+        ('quota_hours_per_month', int, None),  # None: no limit
+        ('zoom', UserZoom, None),
+    ]
 
-    def to_dict(self):
-        return utils.to_dict(self)
+    def has_zoom(self):
+        return self.zoom and self.zoom.access_token
@@ -0,0 +1,142 @@
+import hashlib
+import hmac
+import queue
+import threading
+
+# Events waiting for a slow connection are dropped beyond QUEUE_SIZE, oldest
+# first; each event holds the whole state, so the latest one is enough.
+QUEUE_SIZE = 16
+
+
+class SessionEvents:
+    """
+    Fans the changes of session documents out to the connections following
+    them, each with its own queue of events.
+
+    A single Firestore listener per session serves all its connections. It
+    starts with the first connection and stops with the last one. At most
+    `max_streams` connections are followed at once.
+    """
+
+    def __init__(self, collection, logger, max_streams):
+        self.collection = collection
+        self.logger = logger
+        self.max_streams = max_streams
+        self.streams = 0
+        self.topics = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, session_id):
+        """
+        A queue receiving the events of a session, starting with its current
+        state if known, or None if too many connections are open. Pass it to
+        `unsubscribe` once done.
+        """
+        events = queue.Queue(maxsize=QUEUE_SIZE)
+        with self.lock:
+            if self.streams >= self.max_streams:
+                return None
+            self.streams += 1
+            topic = self.topics.get(session_id)
+            if topic is None:
+                topic = self.topics[session_id] = Topic()
+                start = True
+            else:
+                start = False
+            topic.queues.add(events)
+            if topic.last is not None:
+                publish(events, topic.last)
+        if start:
+            # Outside of the lock, as the listener may call back at once.
+            watch = self.collection.document(session_id).on_snapshot(
+                lambda docs, changes, read_time: self._on_snapshot(session_id, docs))
+            with self.lock:
+                if self.topics.get(session_id) is topic and topic.queues:
+                    topic.watch = watch
+                    watch = None
+            if watch is not None:
+                watch.unsubscribe()
+        return events
+
+    def unsubscribe(self, session_id, events):
+        """
+        Stop following a session. Unsubscribing a queue again does nothing.
+        """
+        watch = None
+        with self.lock:
+            topic = self.topics.get(session_id)
+            if topic is None or events not in topic.queues:
+                return
+            topic.queues.discard(events)
+            self.streams -= 1
+            if not topic.queues:
+                del self.topics[session_id]
+                watch = topic.watch
+        if watch is not None:
+            watch.unsubscribe()
+
+    def _on_snapshot(self, session_id, docs):
+        try:
+            event = to_event(docs[0] if docs else None)
+        except Exception as e:
+            self.logger.warning('Unable to read event of session: {}, with error: {}'.format(session_id, e))
+            return
+        with self.lock:
+            topic = self.topics.get(session_id)
+            if topic is None or event == topic.last:
+                return
+            topic.last = event
+            for events in topic.queues:
+                publish(events, event)
+
+
+class Topic:
+    def __init__(self):
+        self.queues = set()
+        self.watch = None
+        self.last = None
+
+
+def to_event(snapshot):
+    """
+    The part of a session followed by the UI: the status of its instance and
+    where to reach it, or whether the session was deleted.
+    """
+    if snapshot is None or not snapshot.exists:
+        return {'deleted': True}
+    instance = snapshot.to_dict().get('instance') or {}
+    return {
+        'deleted': False,
+        'status': instance.get('status'),
+        'ip': instance.get('ip'),
+        'warming_at': instance.get('warming_at'),
+        'launched_at': instance.get('launched_at'),
+    }
+
+
+def sign_ticket(secret, session_id, expires_at):
+    """
+    A ticket to follow the events of a session until the timestamp
+    `expires_at`, given in the URL in place of the ID token.
+    """
+    message = '{}:{}'.format(session_id, int(expires_at))
+    return '{}.{}'.format(int(expires_at), hmac.new(secret.encode(), message.encode(), hashlib.sha256).hexdigest())
+
+
+def verify_ticket(secret, session_id, ticket, now):
+    expires_at, _, _ = (ticket or '').partition('.')
+    if not expires_at.isdigit() or int(expires_at) < now:
+        return False
+    return hmac.compare_digest(sign_ticket(secret, session_id, int(expires_at)), ticket)
+
+
+def publish(events, event):
+    while True:
+        try:
+            events.put_nowait(event)
+            return
+        except queue.Full:
+            try:
+                events.get_nowait()
+            except queue.Empty:
+                pass
@@ -1,81 +1,215 @@
 import os
+import socket
+import tempfile
+import threading
+import time
 from collections import namedtuple
-from . import utils
+from . import utils, cache, metrics, placement, profiles
+import json
 import requests
+import httplib2
+import google.auth
+import google_auth_httplib2
 import googleapiclient.discovery
+import googleapiclient.errors
 
 PROJECT = 'narupa-web-ui'
+INSTANCE_TAG = 'narupa-simulation'
+POOL_LABEL = 'narupa-pool'
+POOL_CLAIMED_AT_LABEL = 'narupa-pool-claimed-at'
 NAAS_SIMULATION_TARBALL = os.environ.get('NAAS_SIMULATION_TARBALL')
 
+COMPUTE_SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+COMPUTE_HTTP_TIMEOUT = 30
+# zoneOperations().wait answers within about two minutes, whether or not the
+# operation is done, so its client waits longer than the others.
+COMPUTE_WAIT_HTTP_TIMEOUT = int(os.environ.get('COMPUTE_WAIT_HTTP_TIMEOUT', 150))
+DISCOVERY_URL = 'https://compute.googleapis.com/$discovery/rest?version=v1'
+DISCOVERY_CACHE_PATH = os.environ.get(
+    'COMPUTE_DISCOVERY_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'compute-v1-discovery.json'))
+IMAGE_CACHE_TTL = int(os.environ.get('IMAGE_CACHE_TTL', 600))
+
+InstanceState = namedtuple('InstanceState', ['status', 'ip', 'zone', 'labels', 'has_session'])
+
+_discovery_lock = threading.Lock()
+_discovery_document = None
+_thread_local = threading.local()
+_shared_client = None
+_image_cache = cache.TTLCache(IMAGE_CACHE_TTL)
+
 
 def get_compute_client():
-    return googleapiclient.discovery.build('compute', 'v1', cache_discovery=False)
+    """
+    Get the Compute client of the current thread.
+
+    httplib2 transports are not thread safe, so each thread builds its own
+    client the first time it needs one, then reuses it for the life of the
+    thread.
+    """
+    if _shared_client is not None:
+        return _shared_client
+    client = getattr(_thread_local, 'compute', None)
+    if client is None:
+        client = build_compute_client()
+        _thread_local.compute = client
+    return client
+
+
+def get_wait_client():
+    """
+    Get the Compute client of the current thread for waiting on operations,
+    with a transport timeout of COMPUTE_WAIT_HTTP_TIMEOUT.
+    """
+    if _shared_client is not None:
+        return _shared_client
+    client = getattr(_thread_local, 'compute_wait', None)
+    if client is None:
+        client = build_compute_client(timeout=COMPUTE_WAIT_HTTP_TIMEOUT)
+        _thread_local.compute_wait = client
+    return client
+
+
+def use_compute_client(client):
+    """
+    Make every thread use the given client, such as a fake Compute API for the
+    benchmarks, or go back to per-thread clients with None.
+    """
+    global _shared_client
+    _shared_client = client
+
+
+def build_compute_client(credentials=None, timeout=COMPUTE_HTTP_TIMEOUT):
+    if credentials is None:
+        credentials, _ = google.auth.default(scopes=COMPUTE_SCOPES)
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=timeout))
+    return googleapiclient.discovery.build_from_document(get_discovery_document(), http=http)
+
+
+def get_discovery_document():
+    """
+    Get the Compute discovery document, fetching it only if it is neither in
+    memory nor in the local file cache.
+    """
+    global _discovery_document
+    with _discovery_lock:
+        if _discovery_document is None:
+            try:
+                with open(DISCOVERY_CACHE_PATH) as f:
+                    _discovery_document = f.read()
+            except OSError:
+                response = requests.get(DISCOVERY_URL, timeout=COMPUTE_HTTP_TIMEOUT)
+                response.raise_for_status()
+                _discovery_document = response.text
+                write_discovery_cache(_discovery_document)
+        return _discovery_document
+
+
+def write_discovery_cache(document):
+    # Write then rename so that concurrent workers never read a partial file.
+    directory = os.path.dirname(DISCOVERY_CACHE_PATH) or '.'
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+        f.write(document)
+    os.replace(f.name, DISCOVERY_CACHE_PATH)
 
 
 # Based on GPU availability from https://cloud.google.com/compute/docs/gpus#gpus-list
+# The zones of each region are listed by order of preference.
+REGION_ZONES = {
+    'asia-east1': ['a', 'c'],               # Taiwan
+    'asia-northeast1': ['a', 'c'],          # Tokyo
+    'asia-northeast3': ['b', 'c'],          # Seoul
+    'asia-south1': ['a', 'b'],              # Mumbai
+    'asia-southeast1': ['b', 'a', 'c'],     # Singapore
+    'europe-west2': ['a', 'b'],             # London
+    'europe-west3': ['b'],                  # Frankfurt
+    'europe-west4': ['b', 'c'],             # Netherlands
+    'southamerica-east1': ['c'],            # Sao Paolo
+    'us-central1': ['a', 'b', 'c', 'f'],    # Iowa
+    'us-east1': ['c', 'd'],                 # South Carolina
+    'us-east4': ['b', 'a', 'c'],            # North Virginia
+    'us-west1': ['a', 'b']                  # Oregon
+}
+
+zone_placement = placement.ZonePlacement(REGION_ZONES)
+
+
 def get_zone_for_region(region):
-    region_to_zone = {
-        'asia-east1': 'a',              # Taiwan
-        'asia-northeast1': 'a',         # Tokyo
-        'asia-northeast3': 'b',         # Seoul
-        'asia-south1': 'a',             # Mumbai
-        'asia-southeast1': 'b',         # Singapore
-        'europe-west2': 'a',            # London
-        'europe-west3': 'b',            # Frankfurt
-        'europe-west4': 'b',            # Netherlands
-        'southamerica-east1': 'c',      # Sao Paolo
-        'us-central1': 'a',             # Iowa
-        'us-east1': 'c',                # South Carolina
-        'us-east4': 'b',                # North Virginia
-        'us-west1': 'a'                 # Oregon
-    }
-    zone = region_to_zone.get(region, None)
+    zone = REGION_ZONES.get(region, [None])[0]
     return '{}-{}'.format(region, zone)
 
 
+def get_region_for_zone(zone):
+    return zone.rsplit('-', 1)[0]
+
+
 def choose_image(tag: str) -> str:
     """
     Look for the latest VM image with the requested tag set to 'true'.
 
     This VM image is the one to use for that tag. The function returns the name
-    of the image if one is found, and raises a ValueError otherwise.
+    of the image if one is found, and raises a ValueError otherwise. Answers
+    are cached for IMAGE_CACHE_TTL seconds, see `invalidate_image_cache`.
     """
-    Image = namedtuple('Image', ['timestamp', 'name'])
-    result = []
-    service = get_compute_client()
-    request = service.images().list(project=PROJECT)
-    while request is not None:
-        response = request.execute()
-        for image in response['items']:
-            if image.get('labels', {}).get(tag) == 'true':
-                result.append(Image(image['creationTimestamp'], image['name']))
-        request = service.images().list_next(
-            previous_request=request, previous_response=response)
-    if not result:
+    name = _image_cache.get(tag)
+    if name is None:
+        name = find_latest_image(tag)
+        _image_cache.set(tag, name)
+    return name
+
+
+# https://cloud.google.com/compute/docs/reference/rest/v1/images/list
+@metrics.timed('compute')
+def find_latest_image(tag: str) -> str:
+    response = get_compute_client().images().list(
+        project=PROJECT,
+        filter='labels.{}=true'.format(tag),
+        orderBy='creationTimestamp desc',
+        maxResults=1,
+    ).execute()
+    items = response.get('items', [])
+    if not items:
         raise ValueError(f'No image was found with the tag "{tag}" set to true.')
-    # Ideally, the filtering and the sorting should be done directly in the
-    # API with the orderBy and the filter arguments. I did not manage yet,
-    # though.
-    return sorted(result)[-1].name
+    return items[0]['name']
+
+
+def invalidate_image_cache(tag=None):
+    """
+    Forget the cached image for a tag, or for all tags if none is given.
+
+    To be called when an image is published or relabelled.
+    """
+    if tag is None:
+        _image_cache.clear()
+    else:
+        _image_cache.pop(tag)
+
+
+def image_cache_stats():
+    return _image_cache.stats()
 
 
 # https://cloud.google.com/compute/docs/reference/rest/v1/instances/insert
-def create_instance(tag, region, branch, runner, duration, end_time, timezone, simulation=None, topology=None, trajectory=None):
-    zone = get_zone_for_region(region)
+def create_pool_instance(tag, region, branch, max_idle):
+    """
+    Create an instance of the warm pool. It boots without a session, builds
+    `branch`, and waits for `claim_pool_instance` to give it one, or deletes
+    itself once idle for `max_idle` seconds.
+    """
+    metadata = [
+        { 'key': 'pool', 'value': 'true' },
+        { 'key': 'pool_branch', 'value': branch },
+        { 'key': 'pool_max_idle', 'value': str(max_idle) },
+    ]
+    return place_instance(tag, region, metadata, labels={POOL_LABEL: 'idle'})
 
-    machine_type = 'n1-highcpu-2'
-    gpu_type = 'nvidia-tesla-t4'
-    disk_size_gb = '50'
 
-    name = 'narupa-simulation-{}'.format(utils.generate_short_id())
+def get_session_metadata(branch, runner, duration, end_time, timezone, simulation=None, topology=None, trajectory=None):
     metadata = [
-        { 'key': 'google-logging-enabled', 'value': 'true' },
         { 'key': 'branch', 'value': branch },
         { 'key': 'runner', 'value': runner },
         { 'key': 'duration', 'value': duration },
         { 'key': 'end_time', 'value': end_time },
         { 'key': 'timezone', 'value': timezone },
-        { 'key': 'startup-script', 'value': '#!/bin/bash\nwget -O tmp.tar "{}"\ntar xf tmp.tar --strip-components=2\nchmod +x start.sh\n./start.sh'.format(NAAS_SIMULATION_TARBALL)}
     ]
     if simulation:
         metadata.append({ 'key': 'simulation', 'value': simulation })
@@ -83,11 +217,78 @@ def create_instance(tag, region, branch, runner, duration, end_time, timezone, s
         metadata.append({ 'key': 'topology', 'value': topology })
     if trajectory:
         metadata.append({ 'key': 'trajectory', 'value': trajectory })
+    return metadata
+
+
+class OperationError(Exception):
+    def __init__(self, error):
+        super().__init__(error)
+        self.codes = [item.get('code') for item in error.get('errors', [])]
+
+
+def get_error_codes(error):
+    if isinstance(error, OperationError):
+        return error.codes
+    try:
+        return [item.get('reason') for item in json.loads(error.content)['error']['errors']]
+    except (ValueError, KeyError, TypeError):
+        return []
+
+
+def place_instance(tag, region, metadata, labels=None, profile=None):
+    """
+    Create an instance in the first zone of the region that can host it.
+
+    Zones are tried in the order given by `zone_placement`. A zone failing for
+    lack of capacity is recorded as such, and the next zone is tried. If the
+    wait for the insert times out, the instance is still being created and
+    its status is PENDING.
+    """
+    error = ValueError('No zone known for region {}'.format(region))
+    for zone in zone_placement.candidates(region):
+        try:
+            response = insert_instance(tag, region, metadata, labels=labels, zone=zone, profile=profile)
+            try:
+                operation = wait_for_operation(zone, response['name'])
+            except socket.timeout:
+                response['status'] = 'PENDING'
+                return response
+            if 'error' in operation:
+                raise OperationError(operation['error'])
+        except (googleapiclient.errors.HttpError, OperationError) as e:
+            if not any(code in placement.CAPACITY_ERRORS for code in get_error_codes(e)):
+                raise
+            zone_placement.record_failure(zone)
+            error = e
+            continue
+        zone_placement.record_success(zone)
+        response['status'] = operation['status']
+        return response
+    raise error
+
+
+# https://cloud.google.com/compute/docs/reference/rest/v1/zoneOperations/wait
+@metrics.timed('compute')
+def wait_for_operation(zone, operation):
+    return get_wait_client().zoneOperations().wait(project=PROJECT, zone=zone, operation=operation).execute()
+
+
+@metrics.timed('compute')
+def insert_instance(tag, region, metadata, labels=None, zone=None, profile=None):
+    zone = zone or get_zone_for_region(region)
+    profile = profile or profiles.PROFILES[profiles.DEFAULT_PROFILE]
+
+    name = '{}-{}'.format(INSTANCE_TAG, utils.generate_short_id())
+    metadata = [
+        { 'key': 'google-logging-enabled', 'value': 'true' },
+        { 'key': 'startup-script', 'value': '#!/bin/bash\nwget -O tmp.tar "{}"\ntar xf tmp.tar --strip-components=2\nchmod +x start.sh\n./start.sh'.format(NAAS_SIMULATION_TARBALL)}
+    ] + metadata
 
     config = {
         'name': name,
+        'labels': labels or {},
         'zone': 'projects/{}/zones/{}'.format(PROJECT, zone),
-        'machineType': 'projects/{}/zones/{}/machineTypes/{}'.format(PROJECT, zone, machine_type),
+        'machineType': 'projects/{}/zones/{}/machineTypes/{}'.format(PROJECT, zone, profile.machine_type),
         'displayDevice': {
             'enableDisplay': False
         },
@@ -95,14 +296,14 @@ def create_instance(tag, region, branch, runner, duration, end_time, timezone, s
             'items': metadata
         },
         'tags': {
-            'items': [ 'narupa-simulation' ]
+            'items': [ INSTANCE_TAG ]
         },
         'guestAccelerators': [
             {
-            'acceleratorCount': 1,
-            'acceleratorType': 'projects/{}/zones/{}/acceleratorTypes/{}'.format(PROJECT, zone, gpu_type)
+            'acceleratorCount': profile.gpu_count,
+            'acceleratorType': 'projects/{}/zones/{}/acceleratorTypes/{}'.format(PROJECT, zone, profile.gpu_type)
             }
-        ],
+        ] if profile.gpu_count else [],
         'disks': [
             {
             'type': 'PERSISTENT',
@@ -113,7 +314,7 @@ def create_instance(tag, region, branch, runner, duration, end_time, timezone, s
             'initializeParams': {
                 "sourceImage": "projects/narupa-web-ui/global/images/{}".format(choose_image(tag)),
                 'diskType': 'projects/{}/zones/{}/diskTypes/pd-standard'.format(PROJECT, zone),
-                'diskSizeGb': disk_size_gb
+                'diskSizeGb': str(profile.disk_size_gb)
             },
             'diskEncryptionKey': {}
             }
@@ -160,14 +361,51 @@ def create_instance(tag, region, branch, runner, duration, end_time, timezone, s
 
     response = get_compute_client().instances().insert(project=PROJECT, zone=zone, body=config).execute()
     response['instanceName'] = name
+    response['zone'] = zone
     return response
 
 
+# https://cloud.google.com/compute/docs/reference/rest/v1/instances/setLabels
+# https://cloud.google.com/compute/docs/reference/rest/v1/instances/setMetadata
+@metrics.timed('compute')
+def claim_pool_instance(zone, name, metadata):
+    """
+    Give a session to an idle instance of the warm pool.
+
+    The instance is relabelled first; the label fingerprint makes the call fail
+    if another claim changed the labels since the instance was read. If the
+    session cannot be set once the instance is claimed, the instance is
+    deleted rather than left waiting for a session.
+    """
+    instances = get_compute_client().instances()
+    instance = instances.get(project=PROJECT, zone=zone, instance=name).execute()
+    if instance.get('labels', {}).get(POOL_LABEL) != 'idle':
+        raise ValueError('Instance {} is not idle'.format(name))
+
+    labels = dict(instance.get('labels', {}), **{POOL_LABEL: 'claimed', POOL_CLAIMED_AT_LABEL: str(int(time.time()))})
+    instances.setLabels(project=PROJECT, zone=zone, instance=name, body={
+        'labels': labels,
+        'labelFingerprint': instance['labelFingerprint'],
+    }).execute()
+
+    items = instance['metadata'].get('items', []) + metadata
+    try:
+        instances.setMetadata(project=PROJECT, zone=zone, instance=name, body={
+            'items': items,
+            'fingerprint': instance['metadata']['fingerprint'],
+        }).execute()
+    except Exception:
+        instances.delete(project=PROJECT, zone=zone, instance=name).execute()
+        raise
+
+
 # https://cloud.google.com/compute/docs/reference/rest/v1/instances/get
-def get_instance(region, name):
-    zone = get_zone_for_region(region)
+def get_instance(region, name, zone=None):
+    zone = zone or get_zone_for_region(region)
     try:
-        response = get_compute_client().instances().get(project=PROJECT, zone=zone, instance=name).execute()
+        # Timed apart from the status probe, which get_narupa_status times.
+        with metrics.outbound('compute'):
+            response = get_compute_client().instances().get(project=PROJECT, zone=zone, instance=name).execute()
         ip = response['networkInterfaces'][0]['accessConfigs'][0]['natIP']
         response['instanceIp'] = ip
         response['narupaStatus'] = get_narupa_status(ip)
@@ -176,13 +414,71 @@ def get_instance(region, name):
         return {'narupaStatus': False, 'status': 'UNKNOWN'}
 
 
+# https://cloud.google.com/compute/docs/reference/rest/v1/instances/aggregatedList
+@metrics.timed('compute')
+def list_instances():
+    """
+    List the simulation instances of every zone in a single paged call.
+
+    Returns a dictionary mapping instance names to their status, IP, zone,
+    labels and whether they were given a session. The API cannot filter on network tags, so the listing is filtered
+    on the name prefix shared by all the tagged instances, then on the tag
+    itself.
+    """
+    index = {}
+    service = get_compute_client()
+    request = service.instances().aggregatedList(project=PROJECT, filter='name eq {}-.*'.format(INSTANCE_TAG))
+    while request is not None:
+        response = request.execute()
+        for scoped_list in response.get('items', {}).values():
+            for instance in scoped_list.get('instances', []):
+                if INSTANCE_TAG in instance.get('tags', {}).get('items', []):
+                    index[instance['name']] = InstanceState(
+                        instance['status'],
+                        get_instance_ip(instance),
+                        instance['zone'].rsplit('/', 1)[-1],
+                        instance.get('labels', {}),
+                        any(item['key'] == 'runner' for item in instance.get('metadata', {}).get('items', [])),
+                    )
+        request = service.instances().aggregatedList_next(
+            previous_request=request, previous_response=response)
+    return index
+
+
+def get_indexed_instance(index, name, narupa_statuses=None):
+    """
+    Same as `get_instance`, but reads the instance from a `list_instances` index.
+
+    The narupa status is read from `narupa_statuses`, as returned by
+    `probe.StatusProber.probe`, when it is given.
+    """
+    state = index.get(name)
+    if state is None:
+        return {'narupaStatus': False, 'status': 'UNKNOWN'}
+    if not state.ip:
+        return {'narupaStatus': False, 'status': state.status}
+    if narupa_statuses is None:
+        narupa_status = get_narupa_status(state.ip)
+    else:
+        narupa_status = narupa_statuses.get(state.ip, False)
+    return {'narupaStatus': narupa_status, 'status': state.status, 'instanceIp': state.ip}
+
+
+def get_instance_ip(instance):
+    try:
+        return instance['networkInterfaces'][0]['accessConfigs'][0]['natIP']
+    except (KeyError, IndexError):
+        return None
+
 
 # https://cloud.google.com/compute/docs/reference/rest/v1/instances/delete
-def delete_instance(region, name):
-    zone = get_zone_for_region(region)
+@metrics.timed('compute')
+def delete_instance(region, name, zone=None):
+    zone = zone or get_zone_for_region(region)
     get_compute_client().instances().delete(project=PROJECT, zone=zone, instance=name).execute()
 
 
+@metrics.timed('probe')
 def get_narupa_status(ip):
     try:
         response = requests.get('http://{}:5000/api/status'.format(ip), timeout=5)
@@ -1,9 +1,107 @@
+import logging
+import os
+import threading
+import time
 import requests
 import urllib
+from . import metrics
 
+GITLAB_URL = os.environ.get('GITLAB_URL', 'https://gitlab.com')
 
+# The project whose branches sessions run.
+NARUPA_PROJECT_ID = '11262591'
+
+# Seconds to wait for GitLab to connect and for each read of its answer.
+TIMEOUT = float(os.environ.get('GITLAB_TIMEOUT', 5))
+
+# The branches of a project are listed again once the list is BRANCH_TTL
+# seconds old, or MISSING_BRANCH_TTL seconds old when asked about a branch
+# missing from it, so that new branches show up quickly.
+BRANCH_TTL = int(os.environ.get('GITLAB_BRANCH_TTL', 10 * 60))
+MISSING_BRANCH_TTL = int(os.environ.get('GITLAB_MISSING_BRANCH_TTL', 60))
+
+PAGE_SIZE = 100
+
+# Connections to GitLab are kept alive from one call to the next.
+session = requests.Session()
+
+
+@metrics.timed('gitlab')
 def has_branch(project_id, branch):
     escape_branch = urllib.parse.quote(branch, safe='')
-    url = f'https://gitlab.com/api/v4/projects/{project_id}/repository/branches/{escape_branch}'
-    response = requests.get(url)
+    url = f'{GITLAB_URL}/api/v4/projects/{project_id}/repository/branches/{escape_branch}'
+    response = session.get(url, timeout=TIMEOUT)
     return response.status_code == requests.codes.ok
+
+
+@metrics.timed('gitlab')
+def list_branches(project_id):
+    """
+    The names of all the branches of a project, following the pages of the
+    listing.
+    """
+    names = []
+    url = f'{GITLAB_URL}/api/v4/projects/{project_id}/repository/branches?per_page={PAGE_SIZE}'
+    while url:
+        response = session.get(url, timeout=TIMEOUT)
+        response.raise_for_status()
+        names.extend(branch['name'] for branch in response.json())
+        url = response.links.get('next', {}).get('url')
+    return names
+
+
+class BranchCache:
+    """
+    The branches of a project, listed in bulk rather than asked for one by
+    one, since GitLab limits the requests per IP address.
+
+    If GitLab cannot be reached, the last list is kept; without any list,
+    branches are asked for one by one.
+    """
+
+    def __init__(self, project_id, ttl=BRANCH_TTL, missing_ttl=MISSING_BRANCH_TTL, clock=time.monotonic):
+        self.project_id = project_id
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self.clock = clock
+        self.branches = None
+        self.listed_at = None
+        self.failed_at = None
+        self.lock = threading.Lock()
+
+    def has_branch(self, branch):
+        branches = self.list_if_older(self.ttl if self.branches is not None and branch in self.branches else self.missing_ttl)
+        if branches is None:
+            return has_branch(self.project_id, branch)
+        return branch in branches
+
+    def names(self):
+        branches = self.list_if_older(self.ttl)
+        if branches is None:
+            raise RuntimeError('Unable to list the branches of project {}'.format(self.project_id))
+        return sorted(branches)
+
+    def list_if_older(self, seconds):
+        """
+        The branches, listed again if the list is older than `seconds`, or
+        None if they could never be listed. A single thread lists them at a
+        time; the others wait for its list. After a failure, listing is not
+        tried again for `missing_ttl` seconds.
+        """
+        checked_at = self.clock()
+        if self.listed_at is not None and checked_at - self.listed_at <= seconds:
+            return self.branches
+
+        with self.lock:
+            if self.listed_at is not None and checked_at - self.listed_at <= seconds:
+                return self.branches
+            if self.failed_at is not None and checked_at - self.failed_at <= self.missing_ttl:
+                return self.branches
+            try:
+                self.branches = frozenset(list_branches(self.project_id))
+                self.listed_at = self.clock()
+                self.failed_at = None
+            except Exception as e:
+                logging.warning('Unable to list branches of project {}: {}'.format(self.project_id, e))
+                self.failed_at = self.clock()
+            return self.branches
@@ -0,0 +1,219 @@
+import threading
+import time
+import uuid
+from firebase_admin import firestore
+from . import metrics, utils, workers
+
+# A failed job is tried again after RETRY_DELAY seconds, doubled after each
+# failure up to MAX_RETRY_DELAY, and given up after MAX_ATTEMPTS attempts.
+MAX_ATTEMPTS = 6
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 10 * 60
+
+# A running job is leased to its worker for LEASE_SECONDS. If the worker has
+# not finished it by then, for instance because its process died, the job is
+# run again by any process.
+LEASE_SECONDS = 5 * 60
+
+# How many due jobs are read at once.
+BATCH_SIZE = 50
+
+
+class JobQueue:
+    """
+    Side effects of the API, such as calls to Zoom, run in the background so
+    that requests do not wait for them.
+
+    A job has a kind, naming the handler that runs it, and a key: enqueuing a
+    job with the key of a pending one replaces it, so a job is queued at most
+    once per key. Handlers may still run more than once for the same job, if
+    a worker dies mid-job, and must be idempotent.
+    """
+
+    def __init__(self, store, logger, concurrency=4, poll_interval=10, clock=time.time):
+        self.store = store
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.handlers = {}
+        self.pool = workers.WorkerPool(concurrency, name='narupa-jobs')
+        self.wake = threading.Event()
+        self.thread = None
+
+    def handler(self, kind):
+        """
+        Decorate the function running the jobs of `kind`, called with their
+        payload. A handler raising an exception fails the attempt.
+        """
+        def decorator(fn):
+            self.handlers[kind] = fn
+            return fn
+        return decorator
+
+    def enqueue(self, kind, key, payload, delay=0):
+        now = self.clock()
+        self.store.put(key, {
+            'kind': kind,
+            'payload': payload,
+            'status': 'queued',
+            'token': uuid.uuid4().hex,
+            'attempts': 0,
+            'due_at': now + delay,
+            'error': None,
+            'created_at': utils.now_in_timezone('UTC'),
+        })
+        self.wake.set()
+        return key
+
+    def start(self):
+        """
+        Run the due jobs in a background thread, whenever a job is enqueued
+        in this process and every `poll_interval` seconds for the others.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run_forever, name='narupa-job-queue', daemon=True)
+            self.thread.start()
+
+    def _run_forever(self):
+        while True:
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+            try:
+                self.run_due()
+            except Exception as e:
+                self.logger.warning('Unable to run jobs: {}'.format(e))
+
+    def run_due(self):
+        jobs = self.store.due(self.clock(), BATCH_SIZE)
+        if jobs:
+            self.pool.run(self.run_job, jobs)
+        return len(jobs)
+
+    def run_job(self, item):
+        key, token = item
+        now = self.clock()
+        job = self.store.claim(key, token, now, LEASE_SECONDS)
+        if job is None:
+            # Claimed by another worker, or replaced since it was read.
+            return
+
+        kind = job['kind']
+        try:
+            handler = self.handlers[kind]
+            handler(job['payload'])
+        except Exception as e:
+            if job['attempts'] >= MAX_ATTEMPTS:
+                self.logger.warning('Giving up job: {}, after {} attempts, with error: {}'.format(key, job['attempts'], e))
+                self.store.finish(key, token, {'status': 'failed', 'due_at': None, 'error': str(e)})
+                metrics.JOB_RUNS.labels(kind, 'failed').inc()
+            else:
+                delay = min(RETRY_DELAY * 2 ** (job['attempts'] - 1), MAX_RETRY_DELAY)
+                self.logger.warning('Unable to run job: {}, retrying in {} s, with error: {}'.format(key, delay, e))
+                self.store.finish(key, token, {'status': 'queued', 'due_at': now + delay, 'error': str(e)})
+                metrics.JOB_RUNS.labels(kind, 'retried').inc()
+            return
+
+        self.store.finish(key, token, None)
+        metrics.JOB_RUNS.labels(kind, 'done').inc()
+
+
+def is_due(job, now):
+    """
+    Whether a job should run: `due_at` is the time a queued job is to run at,
+    or the time the lease of a running job ends, and None once it failed.
+    """
+    return job is not None and job.get('due_at') is not None and job['due_at'] <= now
+
+
+def claimed(job, now, lease):
+    return {**job, 'status': 'running', 'attempts': job['attempts'] + 1, 'due_at': now + lease}
+
+
+class FirestoreJobStore:
+    """
+    Jobs as documents of a Firestore collection, keyed by their key, shared
+    by every process. Finished jobs are deleted; failed ones are kept.
+    """
+
+    def __init__(self, db, collection='jobs'):
+        self.db = db
+        self.collection = db.collection(collection)
+
+    def put(self, key, job):
+        self.collection.document(key).set(job)
+
+    def due(self, now, limit):
+        # A range on the single due_at field needs no composite index, and
+        # the jobs waiting to be retried later are left out of the limit.
+        query = self.collection.where('due_at', '<=', now).order_by('due_at').limit(limit)
+        return [(doc.id, doc.to_dict()['token']) for doc in query.stream()]
+
+    def claim(self, key, token, now, lease):
+        return claim_job(self.db.transaction(), self.collection.document(key), token, now, lease)
+
+    def finish(self, key, token, updates):
+        """
+        Apply `updates` to a claimed job, or delete it if None, unless it has
+        been replaced since it was claimed.
+        """
+        finish_job(self.db.transaction(), self.collection.document(key), token, updates)
+
+
+@firestore.transactional
+def claim_job(transaction, ref, token, now, lease):
+    snapshot = ref.get(transaction=transaction)
+    job = snapshot.to_dict() if snapshot.exists else None
+    if job is None or job['token'] != token or not is_due(job, now):
+        return None
+    job = claimed(job, now, lease)
+    transaction.set(ref, job)
+    return job
+
+
+@firestore.transactional
+def finish_job(transaction, ref, token, updates):
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict()['token'] != token:
+        return
+    if updates is None:
+        transaction.delete(ref)
+    else:
+        transaction.update(ref, updates)
+
+
+class MemoryJobStore:
+    """
+    Jobs kept in the memory of this process, for running locally without the
+    jobs collection. They are lost when the process exits.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def put(self, key, job):
+        with self.lock:
+            self.jobs[key] = dict(job)
+
+    def due(self, now, limit):
+        with self.lock:
+            due = sorted((job['due_at'], key, job['token']) for key, job in self.jobs.items() if is_due(job, now))
+            return [(key, token) for _, key, token in due[:limit]]
+
+    def claim(self, key, token, now, lease):
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None or job['token'] != token or not is_due(job, now):
+                return None
+            self.jobs[key] = claimed(job, now, lease)
+            return dict(self.jobs[key])
+
+    def finish(self, key, token, updates):
+        with self.lock:
+            job = self.jobs.get(key)
+            if job is None or job['token'] != token:
+                return
+            if updates is None:
+                del self.jobs[key]
+            else:
+                job.update(updates)
@@ -0,0 +1,134 @@
+import threading
+import time
+
+# Boot latencies are counted in BUCKET_SECONDS wide buckets, the last bucket
+# holding everything longer. Each new sample scales the previous counts down
+# by DECAY, so the histogram follows roughly the last 1 / (1 - DECAY) boots.
+BUCKET_SECONDS = 30
+BUCKET_COUNT = 60
+DECAY = 0.97
+
+# The warm-up lead is the PERCENTILE of the boot latency plus MARGIN seconds,
+# once at least MIN_SAMPLES boots have been seen, bounded to
+# [MIN_LEAD, MAX_LEAD].
+PERCENTILE = 0.95
+MARGIN = 2 * 60
+MIN_SAMPLES = 5
+MIN_LEAD = 2 * 60
+MAX_LEAD = 30 * 60
+
+# Processes other than the scheduler read the estimates from Firestore again
+# after RELOAD_INTERVAL seconds.
+RELOAD_INTERVAL = 10 * 60
+
+
+class BootLatencyHistogram:
+    """
+    A rolling histogram of the time between creating an instance and its
+    narupa server answering.
+    """
+
+    def __init__(self, counts=None, samples=0):
+        self.counts = list(counts) if counts else [0.0] * BUCKET_COUNT
+        self.samples = samples
+
+    def record(self, seconds):
+        self.counts = [count * DECAY for count in self.counts]
+        bucket = min(int(max(seconds, 0) // BUCKET_SECONDS), BUCKET_COUNT - 1)
+        self.counts[bucket] += 1
+        self.samples += 1
+
+    def percentile(self, q):
+        """
+        The upper bound, in seconds, of the bucket holding the q-th quantile.
+        """
+        total = sum(self.counts)
+        if total == 0:
+            return None
+        cumulative = 0
+        for bucket, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= q * total:
+                return (bucket + 1) * BUCKET_SECONDS
+        return BUCKET_COUNT * BUCKET_SECONDS
+
+    def to_dict(self):
+        return {'counts': [round(count, 4) for count in self.counts], 'samples': self.samples}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('counts'), data.get('samples', 0))
+
+
+class BootLatencyEstimator:
+    """
+    Boot latency histograms per region, image tag and runner, stored in a
+    Firestore collection, and the warm-up leads derived from them.
+    """
+
+    def __init__(self, collection, logger, clock=time.time):
+        self.collection = collection
+        self.logger = logger
+        self.clock = clock
+        self._histograms = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        histograms = {doc.id: BootLatencyHistogram.from_dict(doc.to_dict()) for doc in self.collection.stream()}
+        with self._lock:
+            self._histograms = histograms
+            self._loaded_at = self.clock()
+
+    def record(self, region, image_tag, runner, seconds):
+        key = self.key(region, image_tag, runner)
+        with self._lock:
+            histogram = self._histograms.setdefault(key, BootLatencyHistogram())
+            histogram.record(seconds)
+            data = histogram.to_dict()
+        self.collection.document(key).set(dict(data, region=region, image_tag=image_tag, runner=runner))
+
+    def lead(self, region, image_tag, runner, default):
+        """
+        How long before its start a session should warm up, in seconds.
+        """
+        self._reload_if_stale()
+        with self._lock:
+            histogram = self._histograms.get(self.key(region, image_tag, runner))
+            if histogram is None or histogram.samples < MIN_SAMPLES:
+                return default
+            latency = histogram.percentile(PERCENTILE)
+        return min(MAX_LEAD, max(MIN_LEAD, latency + MARGIN))
+
+    def estimates(self, image_tag, default):
+        self._reload_if_stale()
+        with self._lock:
+            histograms = list(self._histograms.items())
+        estimates = []
+        for key, histogram in sorted(histograms):
+            region, tag, runner = key.split(':')
+            if tag != image_tag:
+                continue
+            estimates.append({
+                'region': region,
+                'image_tag': tag,
+                'runner': runner,
+                'samples': histogram.samples,
+                'p50': histogram.percentile(0.5),
+                'p95': histogram.percentile(PERCENTILE),
+                'lead': self.lead(region, tag, runner, default),
+            })
+        return estimates
+
+    @staticmethod
+    def key(region, image_tag, runner):
+        return '{}:{}:{}'.format(region, image_tag, runner)
+
+    def _reload_if_stale(self):
+        if self._loaded_at is not None and self.clock() - self._loaded_at < RELOAD_INTERVAL:
+            return
+        try:
+            self.load()
+        except Exception as e:
+            self.logger.warning('Unable to load boot latencies: {}'.format(e))
+            self._loaded_at = self.clock()
@@ -0,0 +1,131 @@
+import functools
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# With several gunicorn workers, PROMETHEUS_MULTIPROC_DIR must point to an
+# empty directory shared by the workers, set before they start. Each worker
+# then writes its metrics there and /metrics aggregates them.
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+REQUEST_LATENCY = Histogram(
+    'naas_http_request_duration_seconds', 'Time spent handling HTTP requests.',
+    ['method', 'route', 'status'])
+
+TICK_DURATION = Histogram(
+    'naas_scheduler_tick_duration_seconds', 'Time spent handling a batch of sessions in the scheduler.',
+    ['kind'], buckets=(0.1, 0.5, 1, 2.5, 5, 10, 20, 30, 50, 60, 120))
+
+SESSIONS = Gauge(
+    'naas_scheduler_sessions', 'Active sessions per instance status, as of the last reconciliation.',
+    ['status'], multiprocess_mode='mostrecent')
+
+OUTBOUND_LATENCY = Histogram(
+    'naas_outbound_request_duration_seconds', 'Time spent in calls to other services.',
+    ['target'])
+
+OUTBOUND_ERRORS = Counter(
+    'naas_outbound_request_errors_total', 'Calls to other services that raised an error.',
+    ['target'])
+
+JOB_RUNS = Counter(
+    'naas_job_runs_total', 'Attempts at background jobs, per kind and outcome (done, retried or failed).',
+    ['kind', 'outcome'])
+
+
+@contextmanager
+def outbound(target):
+    """
+    Time a call to another service, such as 'compute', 'probe', 'firestore',
+    'gitlab' or 'zoom', counting it as an error if it raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        OUTBOUND_ERRORS.labels(target).inc()
+        raise
+    finally:
+        OUTBOUND_LATENCY.labels(target).observe(time.perf_counter() - start)
+
+
+def timed(target):
+    """
+    Decorate a function calling another service, see `outbound`.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with outbound(target):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# The calls of Firestore clients, references and queries that reach Firestore,
+# and those returning another reference or query. The writes of transactions
+# are only sent when they commit.
+FIRESTORE_CALLS = {'get', 'get_all', 'set', 'create', 'update', 'delete', 'stream'}
+FIRESTORE_TRANSACTION_CALLS = {'get', 'get_all', '_begin', '_commit', '_rollback'}
+FIRESTORE_CHAINS = {'collection', 'document', 'where', 'order_by', 'limit', 'select', 'start_after', 'offset'}
+
+
+def instrument_firestore(db):
+    """
+    Wrap a Firestore client so that every call it makes to Firestore is timed
+    as 'firestore', see `outbound`, including those of the references, queries
+    and transactions it hands out.
+    """
+    return InstrumentedFirestore(db, FIRESTORE_CALLS)
+
+
+class InstrumentedFirestore:
+    """
+    Stands for a Firestore object, timing its `calls`. The results of queries
+    and batched reads are read in full within the timing, as they are only
+    fetched while read.
+    """
+
+    def __init__(self, target, calls):
+        self._target = target
+        self._calls = calls
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name in self._calls:
+            return functools.partial(self._call, value, name in ['stream', 'get_all'])
+        if name in FIRESTORE_CHAINS:
+            return lambda *args, **kwargs: InstrumentedFirestore(value(*args, **kwargs), FIRESTORE_CALLS)
+        if name == 'transaction':
+            return lambda *args, **kwargs: InstrumentedFirestore(value(*args, **kwargs), FIRESTORE_TRANSACTION_CALLS)
+        return value
+
+    @staticmethod
+    def _call(fn, stream, *args, **kwargs):
+        with outbound('firestore'):
+            result = fn(*args, **kwargs)
+            if stream:
+                result = list(result)
+        return iter(result) if stream else result
+
+
+def observe_request(method, route, status, seconds):
+    REQUEST_LATENCY.labels(method, route, status).observe(seconds)
+
+
+def set_session_counts(counts):
+    for status, count in counts.items():
+        SESSIONS.labels(status).set(count)
+
+
+def export():
+    """
+    The body and content type of the /metrics response.
+    """
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
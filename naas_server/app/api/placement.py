@@ -0,0 +1,62 @@
+import math
+import threading
+import time
+
+# A zone that failed to place an instance is penalised, and the penalty halves
+# every FAILURE_HALF_LIFE seconds.
+FAILURE_HALF_LIFE = 30 * 60
+
+# Errors meaning that a zone cannot host the instance right now, so that the
+# next zone is worth trying.
+CAPACITY_ERRORS = [
+    'ZONE_RESOURCE_POOL_EXHAUSTED',
+    'ZONE_RESOURCE_POOL_EXHAUSTED_WITH_DETAILS',
+    'QUOTA_EXCEEDED',
+    'RESOURCE_OPERATION_RATE_EXCEEDED',
+]
+
+
+class ZonePlacement:
+    """
+    Choose the zone of a region where to create an instance.
+
+    Each region has an ordered list of candidate zones. Zones that recently
+    failed to host an instance are moved down the list, until their failures
+    decay away.
+    """
+
+    def __init__(self, region_zones, half_life=FAILURE_HALF_LIFE, clock=time.time):
+        self.region_zones = region_zones
+        self.half_life = half_life
+        self.clock = clock
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def candidates(self, region):
+        """
+        The zones of a region, the most likely to succeed first.
+        """
+        zones = ['{}-{}'.format(region, suffix) for suffix in self.region_zones.get(region, [])]
+        return sorted(zones, key=lambda zone: (self.score(zone), zones.index(zone)))
+
+    def score(self, zone):
+        with self._lock:
+            failure = self._failures.get(zone)
+        if failure is None:
+            return 0
+        score, at = failure
+        return score * math.pow(0.5, (self.clock() - at) / self.half_life)
+
+    def record_failure(self, zone):
+        score = self.score(zone)
+        with self._lock:
+            self._failures[zone] = (score + 1, self.clock())
+
+    def record_success(self, zone):
+        with self._lock:
+            self._failures.pop(zone, None)
+
+    def stats(self):
+        with self._lock:
+            zones = list(self._failures)
+        return {zone: round(self.score(zone), 3) for zone in zones}
@@ -0,0 +1,91 @@
+import asyncio
+import random
+import threading
+import aiohttp
+from . import metrics
+
+STATUS_PORT = 5000
+STATUS_PATH = '/api/status'
+CONNECT_TIMEOUT = 2
+READ_TIMEOUT = 3
+RETRIES = 2
+RETRY_DELAY = 0.5
+MAX_CONNECTIONS = 100
+
+
+class StatusProber:
+    """
+    Check the narupa status of many instances concurrently.
+
+    The probes run on an event loop owned by a background thread, and share a
+    keep-alive connection pool that lives as long as the prober. Unreachable
+    instances are retried with a jittered exponential backoff before they are
+    reported as down.
+    """
+
+    def __init__(self, port=STATUS_PORT, path=STATUS_PATH, retries=RETRIES, retry_delay=RETRY_DELAY):
+        self.port = port
+        self.path = path
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._loop = None
+        self._session = None
+        self._lock = threading.Lock()
+
+    def probe(self, ips):
+        """
+        Probe every IP and return a dictionary mapping each IP to True if the
+        narupa server on that instance is up, False otherwise.
+        """
+        ips = list(set(ip for ip in ips if ip))
+        if not ips:
+            return {}
+        with metrics.outbound('probe'):
+            future = asyncio.run_coroutine_threadsafe(self._probe_all(ips), self._get_loop())
+            return future.result()
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            if self._session is not None:
+                asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+                self._session = None
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop = None
+
+    def _get_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='narupa-status-prober', daemon=True).start()
+            return self._loop
+
+    def _get_session(self):
+        # Only called from the event loop thread, so it does not need locking.
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT),
+            )
+        return self._session
+
+    async def _probe_all(self, ips):
+        session = self._get_session()
+        statuses = await asyncio.gather(*(self._probe(session, ip) for ip in ips))
+        return dict(zip(ips, statuses))
+
+    async def _probe(self, session, ip):
+        url = 'http://{}:{}{}'.format(ip, self.port, self.path)
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.get(url) as response:
+                    body = await response.json(content_type=None)
+                    return bool(body['status'])
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError, TypeError):
+                if attempt < self.retries:
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+        return False
+
+
+prober = StatusProber()
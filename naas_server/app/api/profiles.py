@@ -0,0 +1,138 @@
+import ipaddress
+import re
+import socket
+from collections import namedtuple
+from urllib.parse import urljoin, urlparse
+import requests
+
+MachineProfile = namedtuple('MachineProfile', ['name', 'machine_type', 'gpu_type', 'gpu_count', 'disk_size_gb'])
+
+PROFILES = {profile.name: profile for profile in [
+    # Static structures and trajectories only stream frames.
+    MachineProfile('viewer', 'n1-standard-2', None, 0, 50),
+    MachineProfile('viewer-large-disk', 'n1-standard-2', None, 0, 200),
+    # Interactive simulations, the GPU running the physics.
+    MachineProfile('gpu', 'n1-highcpu-2', 'nvidia-tesla-t4', 1, 50),
+    MachineProfile('gpu-large', 'n1-highcpu-8', 'nvidia-tesla-t4', 1, 50),
+]}
+
+# The profile used when nothing is known about the simulation, and the only
+# profile the warm pool serves.
+DEFAULT_PROFILE = 'gpu'
+
+# Interactive simulations with more than LARGE_SYSTEM_PARTICLES particles get
+# more CPUs. Trajectories larger than LARGE_TRAJECTORY_BYTES get a larger disk.
+LARGE_SYSTEM_PARTICLES = 50000
+LARGE_TRAJECTORY_BYTES = 20 * 1024 ** 3
+
+# Files are inspected once, when the simulation is created or its files change,
+# reading at most INSPECT_MAX_BYTES of each. The URLs are given by users, so
+# only http(s) URLs of public addresses are fetched, following at most
+# INSPECT_MAX_REDIRECTS redirects, each checked the same way.
+INSPECT_TIMEOUT = 10
+INSPECT_MAX_BYTES = 200 * 1024 ** 2
+INSPECT_CHUNK_BYTES = 1024 ** 2
+INSPECT_MAX_REDIRECTS = 5
+
+# An OpenMM serialised system has one <Particle .../> element per particle,
+# and a PDB file one ATOM or HETATM record per atom.
+XML_PARTICLE = re.compile(rb'<Particle\b')
+PDB_ATOM = re.compile(rb'^(?:ATOM  |HETATM)', re.MULTILINE)
+
+
+def resolve(simulation):
+    """
+    The machine profile to run a simulation on.
+
+    The profile set on the simulation wins. Otherwise it depends on the runner,
+    the number of particles and the size of the trajectory.
+    """
+    if simulation is None:
+        return PROFILES[DEFAULT_PROFILE]
+    if simulation.machine_profile in PROFILES:
+        return PROFILES[simulation.machine_profile]
+
+    if simulation.runner in ['static', 'trajectory']:
+        if (simulation.trajectory_size or 0) > LARGE_TRAJECTORY_BYTES:
+            return PROFILES['viewer-large-disk']
+        return PROFILES['viewer']
+    if (simulation.particle_count or 0) > LARGE_SYSTEM_PARTICLES:
+        return PROFILES['gpu-large']
+    return PROFILES[DEFAULT_PROFILE]
+
+
+def inspect(simulation):
+    """
+    Measure the files of a simulation, returning the particle count and the
+    trajectory size when they can be found.
+    """
+    found = {'particle_count': None, 'trajectory_size': None}
+    if simulation.runner in ['ase', 'omm'] and simulation.config_url:
+        found['particle_count'] = count_matches(simulation.config_url, XML_PARTICLE)
+    elif simulation.runner in ['static', 'trajectory'] and simulation.topology_url:
+        found['particle_count'] = count_matches(simulation.topology_url, PDB_ATOM)
+    if simulation.runner == 'trajectory' and simulation.trajectory_url:
+        found['trajectory_size'] = get_content_length(simulation.trajectory_url)
+    return found
+
+
+def is_public_url(url):
+    """
+    Whether a URL is http(s) and its host only resolves to public addresses.
+    """
+    try:
+        parsed = urlparse(url)
+        if parsed.scheme not in ['http', 'https'] or not parsed.hostname:
+            return False
+        addresses = socket.getaddrinfo(parsed.hostname, None, proto=socket.IPPROTO_TCP)
+    except (ValueError, socket.error):
+        return False
+    return all(ipaddress.ip_address(address[4][0].split('%')[0]).is_global for address in addresses)
+
+
+def request_public(method, url, stream=False):
+    """
+    Request a public URL, following redirects to public URLs only. Returns
+    None if a URL on the way is not public.
+    """
+    for _ in range(INSPECT_MAX_REDIRECTS + 1):
+        if not is_public_url(url):
+            return None
+        response = requests.request(method, url, allow_redirects=False, stream=stream, timeout=INSPECT_TIMEOUT)
+        if not response.is_redirect:
+            return response
+        response.close()
+        url = urljoin(url, response.headers['Location'])
+    return None
+
+
+def get_content_length(url):
+    response = request_public('HEAD', url)
+    if response is None or response.status_code != requests.codes.ok:
+        return None
+    length = response.headers.get('Content-Length')
+    return int(length) if length and length.isdigit() else None
+
+
+def count_matches(url, pattern):
+    """
+    Count the matches of a line-anchored pattern in a remote file, streaming it.
+    Returns None if the file is unavailable or too large to be read.
+    """
+    response = request_public('GET', url, stream=True)
+    if response is None:
+        return None
+    with response:
+        if response.status_code != requests.codes.ok:
+            return None
+        count = 0
+        read = 0
+        rest = b''
+        for chunk in response.iter_content(INSPECT_CHUNK_BYTES):
+            read += len(chunk)
+            if read > INSPECT_MAX_BYTES:
+                return None
+            # Only complete lines are searched, so no match spans two chunks.
+            lines, _, rest = (rest + chunk).rpartition(b'\n')
+            count += len(pattern.findall(lines + b'\n'))
+        return count + len(pattern.findall(rest))
@@ -0,0 +1,126 @@
+import time
+from firebase_admin import firestore
+from . import utils
+
+
+class QuotaExceeded(utils.ValidationError):
+    pass
+
+
+class MonthlyQuota:
+    """
+    The session minutes of each user per month, kept in one document per user
+    and month so that admission reads a single document.
+
+    A document maps every session of the month to its minutes: the booked
+    duration while the session is upcoming or running, the time its instance
+    actually ran once stopped. Sessions count in the month they start.
+    """
+
+    def __init__(self, db, logger, clock=time.time):
+        self.db = db
+        self.collection = db.collection('quotas')
+        self.logger = logger
+        self.clock = clock
+
+    def reserve(self, user, session):
+        """
+        Reserve the minutes of a new session, raising QuotaExceeded if the user
+        has not got enough minutes left in the month.
+        """
+        self._move(session.user_id, session.id, None, self.month_of(session), self.booked_minutes(session), self.limit_of(user))
+
+    def update(self, user, before, after):
+        """
+        Move the reservation of an updated session to its new month and
+        duration. Only a growing reservation is checked against the quota.
+        """
+        self._move(after.user_id, after.id, self.month_of(before), self.month_of(after), self.booked_minutes(after), self.limit_of(user))
+
+    def release(self, session):
+        self._safely(session, lambda: self._move(session.user_id, session.id, self.month_of(session), None, 0, None))
+
+    def reconcile(self, session):
+        """
+        Replace the reservation of a stopped session by the minutes its
+        instance ran for.
+        """
+        if not session.instance.warming_at:
+            return self.release(session)
+        seconds = self.clock() - utils.to_timestamp(session.instance.warming_at, 'UTC')
+        minutes = round(max(seconds, 0) / 60, 2)
+        month = self.month_of(session)
+        self._safely(session, lambda: self._move(session.user_id, session.id, month, month, minutes, None))
+
+    def usage(self, user, month):
+        doc = self.collection.document(self.key(user.id, month)).get()
+        data = doc.to_dict() if doc.exists else {}
+        return {
+            'month': month,
+            'minutes': data.get('minutes', 0),
+            'limit_minutes': self.limit_of(user),
+        }
+
+    @staticmethod
+    def key(user_id, month):
+        return '{}_{}'.format(user_id, month)
+
+    @staticmethod
+    def month_of(session):
+        return utils.to_datetime(session.start_at).strftime('%Y-%m')
+
+    @staticmethod
+    def booked_minutes(session):
+        return utils.difference_in_minutes(session.start_at, session.end_at)
+
+    @staticmethod
+    def limit_of(user):
+        return None if user.quota_hours_per_month is None else user.quota_hours_per_month * 60
+
+    def _safely(self, session, fn):
+        # Releases and reconciliations must not fail the request or the
+        # scheduler; a failed one leaves the booked minutes reserved.
+        try:
+            fn()
+        except Exception as e:
+            self.logger.warning('Unable to update quota for session: {}, with error: {}'.format(session.id, e))
+
+    def _move(self, user_id, session_id, old_month, new_month, minutes, limit):
+        old_ref = self.collection.document(self.key(user_id, old_month)) if old_month else None
+        new_ref = self.collection.document(self.key(user_id, new_month)) if new_month else None
+        move_reservation(self.db.transaction(), session_id, user_id, old_ref, new_ref, new_month, minutes, limit)
+
+
+@firestore.transactional
+def move_reservation(transaction, session_id, user_id, old_ref, new_ref, month, minutes, limit):
+    """
+    Drop the minutes of a session from `old_ref` and set them in `new_ref`,
+    either being None or both the same document.
+    """
+    # A transaction reads everything before it writes anything.
+    refs = [ref for ref in [old_ref, new_ref] if ref is not None]
+    docs = {ref.path: snapshot_data(ref.get(transaction=transaction)) for ref in refs}
+
+    if old_ref is not None and (new_ref is None or old_ref.path != new_ref.path):
+        data = docs[old_ref.path]
+        data['sessions'].pop(session_id, None)
+        data['minutes'] = sum(data['sessions'].values())
+        transaction.set(old_ref, data)
+
+    if new_ref is not None:
+        data = docs[new_ref.path]
+        previous = data['sessions'].get(session_id, 0)
+        total = sum(data['sessions'].values()) - previous + minutes
+        if limit is not None and minutes > previous and total > limit:
+            raise QuotaExceeded('Monthly quota of {} hours exceeded'.format(int(limit / 60)))
+        data['sessions'][session_id] = minutes
+        data['minutes'] = total
+        data['user_id'] = user_id
+        data['month'] = month
+        transaction.set(new_ref, data)
+
+
+def snapshot_data(snapshot):
+    data = snapshot.to_dict() if snapshot.exists else {}
+    data.setdefault('sessions', {})
+    return data
@@ -0,0 +1,455 @@
+import heapq
+import threading
+import time
+from . import callbacks, classes, gcp, metrics, probe, profiles, utils, workers
+
+ACTIVE_STATUSES = ['LAUNCHED', 'WARMING', 'PENDING']
+
+# WARMING instances are polled with an exponential backoff, LAUNCHED ones at a
+# fixed interval. A session whose handler failed is retried after RETRY_DELAY.
+WARMING_POLL_MIN = 15
+WARMING_POLL_MAX = 60
+LAUNCHED_POLL_INTERVAL = 60
+
+# When instances report their status through callbacks, polling is only a
+# fallback and backs off up to FALLBACK_POLL_INTERVAL.
+FALLBACK_POLL_INTERVAL = 5 * 60
+RETRY_DELAY = 60
+
+# The worker never sleeps longer than this, so a clock jump cannot stall it.
+MAX_SLEEP = 300
+
+
+class DeadlineQueue:
+    """
+    A min-heap of keys ordered by due time, in which a key appears at most once.
+
+    Pushing a key again reschedules it; entries left behind in the heap are
+    skipped when they reach the top.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def push(self, key, due):
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, key))
+
+    def remove(self, key):
+        self._due.pop(key, None)
+
+    def next_due(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        keys = []
+        while True:
+            due = self.next_due()
+            if due is None or due > now:
+                return keys
+            _, key = heapq.heappop(self._heap)
+            del self._due[key]
+            keys.append(key)
+
+
+class NarupaScheduler:
+    """
+    Move sessions through PENDING -> WARMING -> LAUNCHED -> STOPPED.
+
+    Every active session sits in a deadline queue, keyed by the time its next
+    action is due: its warm_up_at while PENDING, its next readiness poll while
+    WARMING or LAUNCHED. A worker thread sleeps until the earliest deadline,
+    then reads and handles only the sessions that are due. The API keeps the
+    queue up to date when sessions are created, updated or deleted, and a
+    periodic `tick` reconciles the queue with Firestore.
+    """
+
+    def __init__(self, db, logger, image_tag, concurrency, tick_deadline, warm_pool=None, boot_latency=None,
+                 callback_url=None, callback_secret=None, usage=None, quota=None, clock=time.time):
+        self.db = db
+        self.logger = logger
+        self.image_tag = image_tag
+        self.tick_deadline = tick_deadline
+        self.warm_pool = warm_pool
+        self.boot_latency = boot_latency
+        self.callback_url = callback_url
+        self.callback_secret = callback_secret
+        self.usage = usage
+        self.quota = quota
+        self.clock = clock
+        self.pool = workers.WorkerPool(concurrency, name='narupa-scheduler')
+        self.deadlines = DeadlineQueue()
+        self._polls = {}
+        self._pending = {}
+        self._tick_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run_forever, name='narupa-scheduler-deadlines', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+
+    def tick(self):
+        """
+        Handle every active session and rebuild the deadline queue from
+        Firestore. Skipped if sessions are being handled already.
+        """
+        if not self._tick_lock.acquire(blocking=False):
+            self.logger.warning('Skipping scheduler tick, the previous tick is still running')
+            return
+        try:
+            with self._wakeup:
+                self.deadlines = DeadlineQueue()
+                self._pending = {}
+            start = time.perf_counter()
+            docs = list(self.db.collection('sessions').where('instance.status', 'in', ACTIVE_STATUSES).stream())
+            metrics.set_session_counts({status: sum(1 for doc in docs if doc.get('instance.status') == status)
+                                        for status in ACTIVE_STATUSES})
+            self.run(self.queue_waiting(docs))
+            metrics.TICK_DURATION.labels('reconcile').observe(time.perf_counter() - start)
+        finally:
+            self._tick_lock.release()
+
+    def queue_waiting(self, docs):
+        """
+        Queue the PENDING sessions that are not due to warm up yet, without
+        reading them into sessions, and return the other documents.
+
+        Most of the sessions read by a tick are booked for later, and have
+        nothing to do but wait in the queue.
+        """
+        now = self.clock()
+        others = []
+        with self._wakeup:
+            for doc in docs:
+                due = self.warm_up_due(doc)
+                if due is not None and due > now:
+                    self._pending[doc.id] = (doc.get('location'), due)
+                    self.deadlines.push(doc.id, due)
+                else:
+                    others.append(doc)
+            self._wakeup.notify()
+        return others
+
+    @staticmethod
+    def warm_up_due(doc):
+        try:
+            if doc.get('instance.status') != 'PENDING':
+                return None
+            return utils.to_timestamp(doc.get('warm_up_at'), doc.get('timezone'))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def schedule(self, session):
+        """
+        Queue the next action of a session, or drop the session from the queue
+        if it has nothing left to do.
+        """
+        due = self.next_action_at(session)
+        with self._wakeup:
+            if session.instance.status != 'WARMING':
+                self._polls.pop(session.id, None)
+            if session.instance.status == 'PENDING' and due is not None:
+                self._pending[session.id] = (session.location, due)
+            else:
+                self._pending.pop(session.id, None)
+            if due is None:
+                self.deadlines.remove(session.id)
+            else:
+                self.deadlines.push(session.id, due)
+            self._wakeup.notify()
+
+    def forget(self, session_id):
+        with self._wakeup:
+            self.deadlines.remove(session_id)
+            self._polls.pop(session_id, None)
+            self._pending.pop(session_id, None)
+            self._wakeup.notify()
+
+    def upcoming(self, horizon):
+        """
+        The number of sessions per region due to warm up within `horizon`
+        seconds.
+        """
+        until = self.clock() + horizon
+        counts = {}
+        with self._wakeup:
+            for location, due in self._pending.values():
+                if due <= until:
+                    counts[location] = counts.get(location, 0) + 1
+        return counts
+
+    def refill_warm_pool(self):
+        if self.warm_pool is not None:
+            self.warm_pool.refill(self.upcoming(self.warm_pool.horizon))
+
+    def next_action_at(self, session):
+        status = session.instance.status
+        if status == 'PENDING':
+            if not session.warm_up_at or not session.timezone:
+                return None
+            return utils.to_timestamp(session.warm_up_at, session.timezone)
+        if status == 'WARMING':
+            polls = self._polls.get(session.id, 0)
+            if self.has_callbacks():
+                return self.clock() + min(FALLBACK_POLL_INTERVAL, WARMING_POLL_MAX * 2 ** polls)
+            return self.clock() + min(WARMING_POLL_MAX, WARMING_POLL_MIN * 2 ** polls)
+        if status == 'LAUNCHED':
+            return self.clock() + (FALLBACK_POLL_INTERVAL if self.has_callbacks() else LAUNCHED_POLL_INTERVAL)
+        return None
+
+    def has_callbacks(self):
+        return bool(self.callback_url and self.callback_secret)
+
+    def run(self, docs):
+        """
+        Handle the given session documents concurrently, then queue their next
+        action.
+        """
+        checked = [doc.get('instance.id') for doc in docs if doc.get('instance.status') != 'PENDING']
+        instances = self.list_instances() if checked else {}
+        statuses = self.probe_instances(instances, checked)
+        deferred = self.pool.run(lambda doc: self.run_session(doc, instances, statuses), docs, deadline=self.tick_deadline)
+        if deferred:
+            self.logger.warning('Scheduler deadline reached, deferring {} sessions'.format(len(deferred)))
+            with self._wakeup:
+                for doc in deferred:
+                    self.deadlines.push(doc.id, self.clock())
+
+    def run_session(self, doc, instances, statuses):
+        try:
+            session = classes.Session(doc)
+        except Exception as e:
+            self.logger.warning('Unable to read session: {}, with error: {}'.format(doc.id, e))
+            return
+        try:
+            if session.instance.status == 'PENDING':
+                self.warm_up(session)
+            elif session.instance.status == 'WARMING':
+                self.warm_up_check(session, instances, statuses)
+            elif session.instance.status == 'LAUNCHED':
+                self.launched_check(session, instances, statuses)
+            self.schedule(session)
+        except Exception as e:
+            self.logger.warning('Unable to run scheduled task on session: {}, with error: {}'.format(doc.id, e))
+            self.logger.exception(e)
+            with self._wakeup:
+                self.deadlines.push(session.id, self.clock() + RETRY_DELAY)
+
+    def list_instances(self):
+        try:
+            return gcp.list_instances()
+        except Exception as e:
+            self.logger.warning('Unable to list instances, falling back to one request per session: {}'.format(e))
+            return None
+
+    def probe_instances(self, instances, names):
+        if instances is None:
+            return None
+        ips = [instances[name].ip for name in names if name in instances]
+        try:
+            return probe.prober.probe(ips)
+        except Exception as e:
+            self.logger.warning('Unable to probe instances, falling back to one probe per session: {}'.format(e))
+            return None
+
+    def get_session_instance(self, session, instances, statuses):
+        if instances is None:
+            return gcp.get_instance(session.location, session.instance.id, session.instance.zone)
+        return gcp.get_indexed_instance(instances, session.instance.id, statuses)
+
+    def save(self, session):
+        data = session.to_dict()
+        # The meeting is written by the Zoom jobs of the API, possibly after
+        # the session was read here.
+        data.pop('zoom_meeting', None)
+        self.db.collection('sessions').document(session.id).set(data, merge=True)
+
+    def warm_up(self, session):
+        if utils.to_timestamp(session.warm_up_at, session.timezone) > self.clock():
+            return
+
+        runner = session.simulation.runner
+        simulation = None
+        topology = None
+        trajectory = None
+        if runner == 'ase' or runner == 'omm':
+            simulation = session.simulation.config_url
+        elif runner == 'static':
+            topology = session.simulation.topology_url
+        elif runner == 'trajectory':
+            topology = session.simulation.topology_url
+            trajectory = session.simulation.trajectory_url
+
+        duration = int(utils.difference_in_seconds(session.warm_up_at, session.end_at))
+        metadata = gcp.get_session_metadata(
+            session.branch,
+            runner, duration,
+            session.end_at,
+            session.timezone,
+            simulation=simulation,
+            topology=topology,
+            trajectory=trajectory,
+        )
+        if self.has_callbacks():
+            metadata += callbacks.get_callback_metadata(self.callback_url, self.callback_secret, session.id)
+
+        # Stamped before placement, so that boot latencies, GPU minutes and
+        # quotas include the time spent creating the instance.
+        warming_at = utils.from_timestamp(self.clock())
+        profile = profiles.resolve(session.simulation)
+        session.instance.machine_profile = profile.name
+        session.instance.gpu_count = profile.gpu_count
+
+        # Pool instances are created with the default profile only.
+        if (self.warm_pool is not None and self.warm_pool.enabled(session.location)
+                and profile.name == profiles.DEFAULT_PROFILE):
+            claimed = self.warm_pool.claim(session.location, metadata)
+            if claimed is not None:
+                session.instance.status = 'WARMING'
+                session.instance.id, session.instance.zone = claimed
+                session.instance.pooled = True
+                session.instance.warming_at = warming_at
+                self.save(session)
+                return
+
+        try:
+            response = gcp.place_instance(self.image_tag, session.location, metadata, profile=profile)
+
+            # The status of the insert operation, done unless the wait for it
+            # timed out, in which case the instance is still being created.
+            if response['status'] in ['PENDING', 'PROVISIONING', 'STAGING', 'RUNNING', 'DONE']:
+                session.instance.status = 'WARMING'
+                session.instance.id = response['instanceName']
+                session.instance.zone = response['zone']
+                session.instance.warming_at = warming_at
+            else:
+                self.logger.warning('Marking instance as failed in state: ' + response['status'])
+                self.mark_failed(session)
+        except Exception as e:
+            self.logger.warning('Failed to create instance: {}'.format(e))
+            self.mark_failed(session)
+
+        self.save(session)
+
+    def warm_up_check(self, session, instances, statuses):
+        response = self.get_session_instance(session, instances, statuses)
+        if response['narupaStatus']:
+            self.mark_launched(session, response['instanceIp'])
+        elif response['status'] not in ['PROVISIONING', 'STAGING', 'RUNNING']:
+            self.logger.warning('Marking instance as failed in state: ' + response['status'])
+            self.mark_failed(session)
+            self.save(session)
+        else:
+            with self._wakeup:
+                self._polls[session.id] = self._polls.get(session.id, 0) + 1
+
+    def mark_launched(self, session, ip):
+        session.instance.status = 'LAUNCHED'
+        session.instance.ip = ip
+        session.instance.launched_at = utils.from_timestamp(self.clock())
+        self.save(session)
+        seconds = self.record_boot_latency(session)
+        if self.usage is not None:
+            self.usage.session_started(session, seconds)
+
+    def mark_stopped(self, session):
+        session.instance.status = 'STOPPED'
+        session.instance.ip = None
+        self.save(session)
+        if self.usage is not None:
+            self.usage.session_stopped(session)
+        if self.quota is not None:
+            self.quota.reconcile(session)
+
+    def mark_failed(self, session):
+        session.instance.status = 'FAILED'
+        if self.usage is not None:
+            self.usage.session_failed(session)
+        if self.quota is not None:
+            self.quota.release(session)
+
+    def record_boot_latency(self, session):
+        """
+        Record how long the instance of a session took to boot, and return it
+        in seconds, or None for an instance that was not booted for it.
+        """
+        # Instances claimed from the warm pool were booted before the session
+        # warmed up, they say nothing about the time a boot takes.
+        if session.instance.pooled or not session.instance.warming_at:
+            return None
+        seconds = self.clock() - utils.to_timestamp(session.instance.warming_at, 'UTC')
+        if self.boot_latency is None:
+            return seconds
+        try:
+            self.boot_latency.record(session.location, self.image_tag, session.simulation.runner, seconds)
+        except Exception as e:
+            self.logger.warning('Unable to record boot latency for session: {}, with error: {}'.format(session.id, e))
+        return seconds
+
+    def launched_check(self, session, instances, statuses):
+        response = self.get_session_instance(session, instances, statuses)
+        if not response['narupaStatus']:
+            self.mark_stopped(session)
+
+    def instance_ready(self, session, ip):
+        """
+        Handle a callback from an instance whose narupa server is up.
+        """
+        if session.instance.status == 'WARMING':
+            self.mark_launched(session, ip)
+        self.schedule(session)
+
+    def instance_stopped(self, session):
+        """
+        Handle a callback from an instance shutting down.
+        """
+        if session.instance.status in ['WARMING', 'LAUNCHED']:
+            self.mark_stopped(session)
+        self.schedule(session)
+
+    def _run_forever(self):
+        self.tick()
+        while True:
+            with self._wakeup:
+                if self._stopped:
+                    return
+                due = self.deadlines.next_due()
+                delay = MAX_SLEEP if due is None else min(MAX_SLEEP, due - self.clock())
+                if delay > 0:
+                    self._wakeup.wait(timeout=delay)
+                    continue
+            self.run_due()
+
+    def run_due(self):
+        """
+        Read and handle the sessions whose next action is due.
+        """
+        with self._wakeup:
+            session_ids = self.deadlines.pop_due(self.clock())
+        if not session_ids:
+            return
+        with self._tick_lock:
+            start = time.perf_counter()
+            refs = [self.db.collection('sessions').document(session_id) for session_id in session_ids]
+            docs = [doc for doc in self.db.get_all(refs) if doc.exists]
+            for doc in docs:
+                if doc.get('instance.status') not in ACTIVE_STATUSES:
+                    self.forget(doc.id)
+            self.run([doc for doc in docs if doc.get('instance.status') in ACTIVE_STATUSES])
+            metrics.TICK_DURATION.labels('deadline').observe(time.perf_counter() - start)
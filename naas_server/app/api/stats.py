@@ -0,0 +1,100 @@
+import time
+from datetime import datetime, timedelta
+import pytz
+from firebase_admin import firestore
+from . import utils
+
+# Usage is rolled up in one document per UTC day, holding the counters for all
+# sessions under 'total', and per region, runner and user under 'regions',
+# 'runners' and 'users'.
+DIMENSIONS = ['regions', 'runners', 'users']
+COUNTERS = ['sessions_started', 'failures', 'gpu_minutes', 'boot_seconds', 'boot_count']
+
+# The longest range of days served at once, and the range served by default.
+MAX_DAYS = 366
+DEFAULT_DAYS = 30
+
+
+class UsageStats:
+    """
+    Usage counters, incremented as sessions change state so that reading them
+    never scans the sessions.
+    """
+
+    def __init__(self, db, logger, clock=time.time):
+        self.db = db
+        self.collection = db.collection('stats')
+        self.logger = logger
+        self.clock = clock
+
+    def session_started(self, session, boot_seconds=None):
+        counters = {'sessions_started': 1}
+        if boot_seconds is not None:
+            counters['boot_seconds'] = boot_seconds
+            counters['boot_count'] = 1
+        self.increment(session, counters)
+
+    def session_failed(self, session):
+        self.increment(session, {'failures': 1})
+
+    def session_stopped(self, session):
+        if not session.instance.warming_at:
+            return
+        minutes = (self.clock() - utils.to_timestamp(session.instance.warming_at, 'UTC')) / 60
+        # Instances created before machine profiles all had one GPU.
+        gpu_count = 1 if session.instance.gpu_count is None else session.instance.gpu_count
+        if gpu_count:
+            self.increment(session, {'gpu_minutes': round(max(minutes, 0) * gpu_count, 2)})
+
+    def increment(self, session, counters):
+        """
+        Add to the counters of the current day for every dimension of a
+        session. Failures are logged, as stats must not break the scheduler.
+        """
+        increments = {name: firestore.Increment(value) for name, value in counters.items()}
+        runner = session.simulation.runner if session.simulation else None
+        keys = {'regions': session.location, 'runners': runner, 'users': session.user_id}
+        data = {'day': self.today(), 'total': dict(increments)}
+        for dimension, key in keys.items():
+            if key:
+                data[dimension] = {key: dict(increments)}
+        try:
+            self.collection.document(data['day']).set(data, merge=True)
+        except Exception as e:
+            self.logger.warning('Unable to record stats for session: {}, with error: {}'.format(session.id, e))
+
+    def today(self):
+        return datetime.fromtimestamp(self.clock(), pytz.utc).strftime('%Y-%m-%d')
+
+    def rollup(self, start, end):
+        """
+        The daily counters from `start` to `end` included, as YYYY-MM-DD
+        strings, and their sum over the range. Without `start`, the range is
+        the DEFAULT_DAYS days up to `end`.
+        """
+        try:
+            last = datetime.strptime(end, '%Y-%m-%d')
+            first = datetime.strptime(start, '%Y-%m-%d') if start else last - timedelta(days=DEFAULT_DAYS - 1)
+        except ValueError:
+            raise utils.ValidationError('Invalid date')
+        if last < first or (last - first).days >= MAX_DAYS:
+            raise utils.ValidationError('Invalid date range')
+
+        days = [(first + timedelta(days=i)).strftime('%Y-%m-%d') for i in range((last - first).days + 1)]
+        docs = list(self.db.get_all([self.collection.document(day) for day in days]))
+        found = sorted((doc.to_dict() for doc in docs if doc.exists), key=lambda data: data['day'])
+
+        totals = {'total': {}}
+        totals.update({dimension: {} for dimension in DIMENSIONS})
+        for data in found:
+            add_counters(totals['total'], data.get('total', {}))
+            for dimension in DIMENSIONS:
+                for key, counters in data.get(dimension, {}).items():
+                    add_counters(totals[dimension].setdefault(key, {}), counters)
+        return {'days': found, 'totals': totals}
+
+
+def add_counters(into, counters):
+    for name in COUNTERS:
+        if name in counters:
+            into[name] = into.get(name, 0) + counters[name]
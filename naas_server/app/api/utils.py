@@ -2,6 +2,11 @@ import uuid
 import random
 import string
 from datetime import datetime, timedelta
+import pytz
+
+# Time in seconds between the creation of an instance and the start of its
+# session.
+DEFAULT_WARM_UP_LEAD = 15 * 60
 
 
 def to_datetime(s):
@@ -16,6 +21,22 @@ def now_plus_seconds(seconds):
     return datetime_plus_seconds(datetime.now(), seconds)
 
 
+def to_timestamp(s, timezone):
+    return pytz.timezone(timezone).localize(to_datetime(s)).timestamp()
+
+
+def from_timestamp(timestamp):
+    return datetime.utcfromtimestamp(timestamp).replace(microsecond=0).isoformat()
+
+
+def to_utc(s, timezone):
+    return from_timestamp(to_timestamp(s, timezone))
+
+
+def now_in_timezone(timezone):
+    return datetime.now(pytz.timezone(timezone)).replace(microsecond=0, tzinfo=None).isoformat()
+
+
 def difference_in_minutes(start_at, end_at):
     return (to_datetime(end_at) - to_datetime(start_at)) / timedelta(minutes=1)
 
@@ -36,8 +57,8 @@ def generate_created_at():
     return datetime.now().replace(microsecond=0).isoformat()
 
 
-def generate_warm_up_at(session):
-    default_warm_up_at = datetime_plus_seconds(to_datetime(session.start_at), -(15 * 60))
+def generate_warm_up_at(session, lead=DEFAULT_WARM_UP_LEAD):
+    default_warm_up_at = datetime_plus_seconds(to_datetime(session.start_at), -lead)
     warm_up_at = max(default_warm_up_at, datetime.now().replace(microsecond=0))
     return warm_up_at.isoformat()
 
@@ -45,27 +66,20 @@ def is_dict(d):
     return type(d) is dict
 
 
-# Taken from https://stackoverflow.com/a/1118038
-def to_dict(obj, classkey=None):
-    if isinstance(obj, dict):
-        data = {}
-        for (k, v) in obj.items():
-            data[k] = to_dict(v, classkey)
-        return data
-    elif hasattr(obj, "_ast"):
-        return to_dict(obj._ast())
-    elif hasattr(obj, "__iter__") and not isinstance(obj, str):
-        return [to_dict(v, classkey) for v in obj]
-    elif hasattr(obj, "__dict__"):
-        data = dict([(key, to_dict(value, classkey))
-            for key, value in obj.__dict__.items()
-            if not callable(value) and not key.startswith('_')])
-        if classkey is not None and hasattr(obj, "__class__"):
-            data[classkey] = obj.__class__.__name__
-        return data
-    else:
-        return obj
-
-
-def pick(d, keys):
-    return {k: d.get(k, None) for k in keys}
\ No newline at end of file
+class ValidationError(ValueError):
+    pass
+
+
+def pick(d, keys, types=None):
+    """
+    Keep only the given keys of a dictionary, missing keys being set to None.
+
+    When `types` maps keys to types, as `classes.Session.types` does, a
+    ValidationError is raised for any picked value of the wrong type.
+    """
+    picked = {k: d.get(k, None) for k in keys}
+    if types is not None:
+        for k, v in picked.items():
+            if v is not None and k in types and not isinstance(v, types[k]):
+                raise ValidationError('Invalid value for {}'.format(k))
+    return picked
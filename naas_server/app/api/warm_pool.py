@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import defaultdict
+from . import gcp
+
+# Idle instances are kept for the sessions warming up within POOL_HORIZON
+# seconds, and for as many sessions as claimed an instance over that period.
+POOL_HORIZON = 30 * 60
+
+# With a pool, a session only needs to warm up long enough before its start
+# for the claimed instance to fetch its simulation. Idle instances build the
+# latest POOL_BRANCH before they wait for a session: a session on another
+# branch still has to build it once it claims an instance.
+POOL_WARM_UP_LEAD = 3 * 60
+POOL_BRANCH = 'master'
+
+# Idle instances delete themselves after POOL_MAX_IDLE seconds, so that they
+# do not outlive a pool that is no longer refilled. A claimed instance still
+# without a session after CLAIM_TIMEOUT seconds is deleted by the refill.
+POOL_MAX_IDLE = 2 * 60 * 60
+CLAIM_TIMEOUT = 10 * 60
+
+BOOTING_STATUSES = ['PROVISIONING', 'STAGING']
+
+
+def parse_sizes(value):
+    """
+    Parse a pool configuration such as 'europe-west3=2,us-east1=1' into a
+    dictionary of region to maximum number of idle instances.
+    """
+    sizes = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        region, size = item.split('=')
+        sizes[region.strip()] = int(size)
+    return sizes
+
+
+class ComputeBackend:
+    """
+    Manage the instances of the warm pool through the Compute API.
+    """
+
+    def __init__(self, image_tag):
+        self.image_tag = image_tag
+        self._zones = {}
+
+    def list_pool(self, claimed_before):
+        """
+        The idle instances of each region, the running ones first, and the
+        (region, name) of the instances claimed before the timestamp
+        `claimed_before` that were never given a session.
+        """
+        idle = defaultdict(list)
+        abandoned = []
+        for name, state in gcp.list_instances().items():
+            pool_label = state.labels.get(gcp.POOL_LABEL)
+            if pool_label == 'idle' and state.status in ['RUNNING'] + BOOTING_STATUSES:
+                idle[gcp.get_region_for_zone(state.zone)].append((state.status != 'RUNNING', name))
+                self._zones[name] = state.zone
+            elif pool_label == 'claimed' and not state.has_session:
+                claimed_at = state.labels.get(gcp.POOL_CLAIMED_AT_LABEL, '')
+                if not claimed_at.isdigit() or int(claimed_at) < claimed_before:
+                    abandoned.append((gcp.get_region_for_zone(state.zone), name))
+                    self._zones[name] = state.zone
+        return {region: [name for _, name in sorted(names)] for region, names in idle.items()}, abandoned
+
+    def create_idle(self, region):
+        response = gcp.create_pool_instance(self.image_tag, region, POOL_BRANCH, POOL_MAX_IDLE)
+        self._zones[response['instanceName']] = response['zone']
+        return response['instanceName']
+
+    def claim(self, region, name, metadata):
+        """
+        Give a session to an idle instance. Returns the zone of the instance.
+        """
+        zone = self._zones.pop(name, None) or gcp.get_zone_for_region(region)
+        gcp.claim_pool_instance(zone, name, metadata)
+        return zone
+
+    def delete(self, region, name):
+        gcp.delete_instance(region, name, self._zones.pop(name, None))
+
+
+class WarmPool:
+    """
+    Booted, idle simulation instances ready to be given a session.
+
+    `sizes` caps the number of idle instances per region. Within that cap, the
+    pool is refilled to match the expected demand, and shrinks when the demand
+    drops. The backend does the actual instance management, see
+    `ComputeBackend` for its interface.
+    """
+
+    def __init__(self, backend, sizes, logger, horizon=POOL_HORIZON, clock=time.time):
+        self.backend = backend
+        self.sizes = sizes
+        self.logger = logger
+        self.horizon = horizon
+        self.clock = clock
+        self._idle = {}
+        self._targets = {}
+        self._claims = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def enabled(self, region):
+        return self.sizes.get(region, 0) > 0
+
+    def warm_up_lead(self, region, branch, competing, default):
+        """
+        The warm-up lead of a session that could claim an idle instance. It
+        is only shortened if an instance is expected to be left for it, that
+        is if fewer than the pool size of other sessions of the region warm
+        up within the horizon before it, and if it runs POOL_BRANCH.
+        """
+        if not self.enabled(region) or branch != POOL_BRANCH or competing >= self.sizes[region]:
+            return default
+        return POOL_WARM_UP_LEAD
+
+    def claim(self, region, metadata):
+        """
+        Give a session to an idle instance of the region. Returns the name and
+        the zone of the instance, or None if no instance could be claimed.
+        """
+        while True:
+            with self._lock:
+                idle = self._idle.get(region)
+                if not idle:
+                    return None
+                name = idle.pop(0)
+                self._claims[region].append(self.clock())
+            try:
+                zone = self.backend.claim(region, name, metadata)
+                return name, zone
+            except Exception as e:
+                # Either claimed by someone else, or deleted by the backend.
+                self.logger.warning('Unable to claim pool instance {}: {}'.format(name, e))
+
+    def refill(self, upcoming):
+        """
+        Create or delete idle instances so that each region has as many as the
+        sessions expected within the horizon, within the configured size, and
+        delete the instances abandoned by failed claims.
+
+        `upcoming` maps regions to the number of sessions warming up within
+        the horizon.
+        """
+        idle, abandoned = self.backend.list_pool(self.clock() - CLAIM_TIMEOUT)
+        for region, name in abandoned:
+            self.logger.warning('Deleting pool instance {}, claimed without a session'.format(name))
+            try:
+                self.backend.delete(region, name)
+            except Exception as e:
+                self.logger.warning('Unable to delete pool instance {}: {}'.format(name, e))
+
+        since = self.clock() - self.horizon
+        with self._lock:
+            for region in self._claims:
+                self._claims[region] = [at for at in self._claims[region] if at > since]
+            demand = {region: upcoming.get(region, 0) + len(self._claims.get(region, [])) for region in self.sizes}
+
+        pool = {}
+        for region, size in self.sizes.items():
+            target = min(size, demand[region])
+            names = list(idle.get(region, []))
+            try:
+                for _ in range(target - len(names)):
+                    names.append(self.backend.create_idle(region))
+                for name in names[target:]:
+                    self.backend.delete(region, name)
+            except Exception as e:
+                self.logger.warning('Unable to resize the warm pool in {}: {}'.format(region, e))
+            pool[region] = names[:target]
+
+        with self._lock:
+            self._idle = pool
+            self._targets = {region: min(size, demand[region]) for region, size in self.sizes.items()}
+
+    def stats(self):
+        with self._lock:
+            return {region: {'size': size, 'target': self._targets.get(region, 0), 'idle': len(self._idle.get(region, []))}
+                    for region, size in self.sizes.items()}
@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+
+
+class WorkerPool:
+    """
+    A long-lived pool of threads running batches of blocking tasks.
+
+    The pool is created once per process so that per-thread resources (such as
+    HTTP clients) survive from one batch to the next.
+    """
+
+    def __init__(self, max_workers, name='narupa-worker'):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def run(self, fn, items, deadline=None):
+        """
+        Call `fn` on every item, with at most `max_workers` calls in flight.
+
+        Items that did not start before `deadline` seconds have passed are
+        cancelled and returned, so the caller can defer them. Calls that
+        already started cannot be interrupted and are waited for.
+        """
+        futures = {self.executor.submit(fn, item): item for item in items}
+        _, not_done = wait(futures, timeout=deadline)
+        deferred = [futures[future] for future in not_done if future.cancel()]
+        wait(not_done)
+        return deferred
+
+    def gather(self, calls, deadline=None, timings=None):
+        """
+        Call the functions of `calls`, a dictionary by name, concurrently and
+        return their results by name.
+
+        As soon as a call raises, its exception is raised without waiting for
+        the others, whose results are dropped. TimeoutError is raised if the
+        calls have not all returned within `deadline` seconds. The seconds
+        each finished call took are added to `timings`, if given.
+        """
+        timings = {} if timings is None else timings
+
+        def timed(name, fn):
+            start = time.perf_counter()
+            try:
+                return fn()
+            finally:
+                timings[name] = time.perf_counter() - start
+
+        futures = {name: self.executor.submit(timed, name, fn) for name, fn in calls.items()}
+        done, not_done = wait(futures.values(), timeout=deadline, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        for future in done:
+            if future.exception() is not None:
+                raise future.exception()
+        if not_done:
+            late = [name for name, future in futures.items() if future in not_done]
+            raise TimeoutError('Calls did not return within {} s: {}'.format(deadline, ', '.join(late)))
+        return {name: future.result() for name, future in futures.items()}
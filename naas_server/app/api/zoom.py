@@ -3,16 +3,22 @@ import requests
 import logging
 import base64
 import os
-from . import classes, utils
+from . import classes, metrics, utils
 
 CLIENT_SECRET = os.environ.get('ZOOM_CLIENT_SECRET')
 CLIENT_ID = os.environ.get('ZOOM_CLIENT_ID')
+OAUTH_URL = os.environ.get('ZOOM_OAUTH_URL', 'https://zoom.us/oauth')
+API_URL = os.environ.get('ZOOM_API_URL', 'https://api.zoom.us/v2')
 
+# Seconds to wait for Zoom to connect and for each read of its answer.
+TIMEOUT = float(os.environ.get('ZOOM_TIMEOUT', 10))
 
+
+@metrics.timed('zoom')
 def init_zoom_tokens(zoom_authorization_code, zoom_redirect_uri):
     headers = {'Authorization': get_service_auth_header()}
-    url = 'https://zoom.us/oauth/token?grant_type=authorization_code&code={}&redirect_uri={}'.format(zoom_authorization_code, zoom_redirect_uri)
-    json = requests.post(url, headers=headers).json()
+    url = '{}/token?grant_type=authorization_code&code={}&redirect_uri={}'.format(OAUTH_URL, zoom_authorization_code, zoom_redirect_uri)
+    json = requests.post(url, headers=headers, timeout=TIMEOUT).json()
     if 'error' in json:
         logging.warning(json)
         return None
@@ -28,12 +34,18 @@ def update_meeting(user, session):
     return upsert_meeting(user, session, update=True)
 
 
+@metrics.timed('zoom')
 def delete_meeting(user, session):
     auth_header = 'Bearer {}'.format(user.zoom.access_token)
     headers = {'Authorization': auth_header}
-    url = 'https://api.zoom.us/v2/meetings/{}'.format(session.zoom_meeting.id)
+    url = '{}/meetings/{}'.format(API_URL, session.zoom_meeting.id)
 
-    requests.delete(url, headers=headers)
+    r = requests.delete(url, headers=headers, timeout=TIMEOUT)
+    # 404: the meeting was already deleted, possibly by a previous attempt.
+    if r.status_code not in [204, 404]:
+        logging.warning('Could not delete Zoom meeting: ' + str(r.status_code))
+        return False
+    return True
 
 
 def get_service_auth_header():
@@ -41,11 +53,12 @@ def get_service_auth_header():
     return 'Basic {}'.format(encoded_credentials.decode())
 
 
+@metrics.timed('zoom')
 def refresh_zoom_tokens(user):
     refresh_token = user.zoom.refresh_token
     headers = {'Authorization': get_service_auth_header()}
-    url = 'https://zoom.us/oauth/token?grant_type=refresh_token&refresh_token={}'.format(refresh_token)
-    json = requests.post(url, headers=headers).json()
+    url = '{}/token?grant_type=refresh_token&refresh_token={}'.format(OAUTH_URL, refresh_token)
+    json = requests.post(url, headers=headers, timeout=TIMEOUT).json()
     if 'error' in json:
         logging.warning(json)
         return None
@@ -53,10 +66,11 @@ def refresh_zoom_tokens(user):
     return classes.UserZoom(json)
 
 
+@metrics.timed('zoom')
 def upsert_meeting(user, session, update=False):
     auth_header = 'Bearer {}'.format(user.zoom.access_token)
     headers = {'Authorization': auth_header}
-    url = 'https://api.zoom.us/v2'
+    url = API_URL
 
     start_at = utils.to_datetime(session.start_at)
     end_at = utils.to_datetime(session.end_at)
@@ -73,14 +87,14 @@ def upsert_meeting(user, session, update=False):
 
     if update:
         url += '/meetings/{}'.format(session.zoom_meeting.id)
-        r = requests.patch(url, headers=headers, json=data)
+        r = requests.patch(url, headers=headers, json=data, timeout=TIMEOUT)
         if r.status_code != 204:
             logging.warning('Could not updated Zoom meeting: ' + str(r.status_code))
             return None
         return classes.ZoomMeeting(session.zoom_meeting.to_dict())
     else:
         url += '/users/me/meetings'
-        json = requests.post(url, headers=headers, json=data).json()
+        json = requests.post(url, headers=headers, json=data, timeout=TIMEOUT).json()
         if 'error' in json:
             logging.warning(json)
             return None
@@ -0,0 +1,155 @@
+import threading
+from datetime import datetime, timedelta
+from firebase_admin import firestore
+from . import classes, utils, zoom
+
+# Access tokens are renewed once they expire within REFRESH_LEAD seconds. The
+# refresher looks for them every REFRESH_INTERVAL seconds, which must be
+# shorter than the lead, among the users with a pending session with a
+# meeting, the ones whose sessions may be updated soon. Jobs refresh the tokens
+# of other users when they need them, see `fresh_user`.
+REFRESH_LEAD = 15 * 60
+REFRESH_INTERVAL = 5 * 60
+
+
+class ZoomTokenRefresher:
+    """
+    Renews the Zoom tokens of users before their access token expires, so
+    that neither requests nor jobs wait for it.
+
+    Zoom hands out a new refresh token with each access token, and the old
+    one stops working. A single thread per user refreshes at a time, and the
+    new tokens are only written if the stored refresh token is still the one
+    that was used, so a refresh is never overwritten by an older one.
+    """
+
+    def __init__(self, db, logger, on_change=None, lead=REFRESH_LEAD, now=datetime.now):
+        self.db = db
+        self.users = db.collection('users')
+        self.logger = logger
+        self.on_change = on_change
+        self.lead = lead
+        self.now = now
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def refresh_expiring(self):
+        """
+        Refresh the tokens of the users with a pending session with a meeting
+        whose access token expires soon.
+        """
+        count = 0
+        for user_id in self.users_with_meetings():
+            try:
+                self.refresh(user_id)
+                count += 1
+            except Exception as e:
+                self.logger.warning('Unable to refresh Zoom tokens for user: {}, with error: {}'.format(user_id, e))
+        return count
+
+    def users_with_meetings(self):
+        query = self.db.collection('sessions').where('instance.status', '==', 'PENDING')
+        users = set()
+        for doc in query.select(['user_id', 'create_conference', 'zoom_meeting']).stream():
+            data = doc.to_dict() or {}
+            if data.get('create_conference') or data.get('zoom_meeting'):
+                users.add(data.get('user_id'))
+        return users
+
+    def fresh_user(self, user_id, lead=60):
+        """
+        The user, with an access token valid for at least `lead` seconds if
+        they have Zoom linked, for jobs about to call Zoom.
+        """
+        user = self.load(user_id)
+        if user is None:
+            return None
+        if user.has_zoom() and self.expires_within(user.zoom, lead):
+            user = self.refresh(user_id, lead)
+        return user
+
+    def refresh(self, user_id, lead=None):
+        """
+        Refresh the tokens of a user if they expire within `lead` seconds,
+        by default the lead of the refresher, and return the user. If their
+        tokens are being refreshed already, wait for that instead.
+        """
+        lock = self.lock_for(user_id)
+        try:
+            if not lock.acquire(blocking=False):
+                with lock:
+                    pass
+                return self.load(user_id)
+            try:
+                return self._refresh(user_id, self.lead if lead is None else lead)
+            finally:
+                lock.release()
+        finally:
+            self.unlock_for(user_id)
+
+    def _refresh(self, user_id, lead):
+        # The user is read again under the lock: a refresh that just
+        # finished has spent the refresh token a caller may still hold.
+        user = self.load(user_id)
+        if user is None or not user.has_zoom() or not self.expires_within(user.zoom, lead):
+            return user
+
+        refresh_token = user.zoom.refresh_token
+        tokens = zoom.refresh_zoom_tokens(user)
+        if tokens is None:
+            # Zoom refused the refresh token, for instance because the user
+            # removed the app; the user has to link Zoom again.
+            self.logger.warning('Zoom refused to refresh tokens for user: {}'.format(user_id))
+
+        ref = self.users.document(user_id)
+        if not swap_tokens(self.db.transaction(), ref, refresh_token, tokens):
+            self.logger.info('Zoom tokens of user: {} changed while refreshing them'.format(user_id))
+            return self.load(user_id)
+
+        user.zoom = tokens
+        if self.on_change is not None:
+            self.on_change(user)
+        return user
+
+    def load(self, user_id):
+        doc = self.users.document(user_id).get()
+        return classes.User(doc) if doc.exists else None
+
+    def expires_within(self, user_zoom, seconds):
+        if not user_zoom.access_token_expires_at:
+            return True
+        return utils.to_datetime(user_zoom.access_token_expires_at) - self.now() <= timedelta(seconds=seconds)
+
+    def lock_for(self, user_id):
+        """
+        The lock of a user, kept until every thread that asked for it called
+        `unlock_for`.
+        """
+        with self.locks_lock:
+            lock, holders = self.locks.get(user_id, (threading.Lock(), 0))
+            self.locks[user_id] = (lock, holders + 1)
+            return lock
+
+    def unlock_for(self, user_id):
+        with self.locks_lock:
+            lock, holders = self.locks[user_id]
+            if holders == 1:
+                del self.locks[user_id]
+            else:
+                self.locks[user_id] = (lock, holders - 1)
+
+
+@firestore.transactional
+def swap_tokens(transaction, ref, refresh_token, tokens):
+    """
+    Replace the Zoom tokens of a user, or remove them if `tokens` is None,
+    unless their refresh token is no longer `refresh_token`.
+    """
+    snapshot = ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+    current = snapshot.to_dict().get('zoom') or {}
+    if current.get('refresh_token') != refresh_token:
+        return False
+    transaction.update(ref, {'zoom': tokens.to_dict() if tokens is not None else firestore.DELETE_FIELD})
+    return True
@@ -18,8 +18,19 @@ export async function updateMeZoom(zoom_authorization_code, zoom_redirect_uri) {
   return _put(`${BASE_API_URL}/api/users/me/zoom`, { zoom_authorization_code, zoom_redirect_uri });
 }
 
+const SESSIONS_PAGE_SIZE = 200;
+
 export async function getSessions() {
-  return _get(`${BASE_API_URL}/api/sessions`);
+  // Sessions are listed a page at a time, following next_cursor to the end.
+  let items = [];
+  let cursor = null;
+  do {
+    const params = `limit=${SESSIONS_PAGE_SIZE}` + (cursor ? `&cursor=${encodeURIComponent(cursor)}` : '');
+    const page = await _get(`${BASE_API_URL}/api/sessions?${params}`);
+    items = items.concat(page.items);
+    cursor = page.next_cursor;
+  } while (cursor);
+  return { items };
 }
 
 export async function getSession(sessionId) {
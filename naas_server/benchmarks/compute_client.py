@@ -0,0 +1,56 @@
+"""
+Per-call overhead of getting a Compute client, before and after the client
+pool.
+
+Run from the naas_server directory:
+
+    python benchmarks/compute_client.py --repeat 20
+
+No request is sent to the Compute API; anonymous credentials are used. The
+discovery document is fetched once if it is not in the local file cache yet.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+import googleapiclient.discovery  # noqa: E402
+from google.auth.credentials import AnonymousCredentials  # noqa: E402
+from api import gcp  # noqa: E402
+
+
+def build_per_call():
+    return googleapiclient.discovery.build(
+        'compute', 'v1', cache_discovery=False, credentials=AnonymousCredentials())
+
+
+def build_from_cached_document():
+    return gcp.build_compute_client(AnonymousCredentials())
+
+
+def reuse_thread_client():
+    return gcp.get_compute_client()
+
+
+def report(name, seconds, repeat):
+    print('{:<28} {:>10.3f} ms/call'.format(name, seconds / repeat * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    # Warm the discovery document cache and the client of this thread.
+    gcp.get_discovery_document()
+    gcp._thread_local.compute = build_from_cached_document()
+
+    report('build(cache_discovery=False)', timeit.timeit(build_per_call, number=args.repeat), args.repeat)
+    report('build_from_document', timeit.timeit(build_from_cached_document, number=args.repeat), args.repeat)
+    report('get_compute_client', timeit.timeit(reuse_thread_client, number=args.repeat), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
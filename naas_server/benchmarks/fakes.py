@@ -0,0 +1,727 @@
+"""
+In-process stand-ins for the services the API talks to, for benchmarks and
+simulations that must run offline:
+
+- FakeFirestore covers the part of the firestore client used by the API:
+  documents, queries, get_all, snapshot listeners and transactions.
+- FakeCompute covers the Compute instances, images and zone operations calls
+  made by gcp.py. Instances boot after a delay, get an IP, and can fail.
+- FakeProber answers the narupa status probes for the fake instances.
+- StubServer is a local HTTP server for the GitLab, Zoom and file endpoints.
+
+Every fake takes a Latency, added to each call, and a clock, so that a
+simulation can run on virtual time.
+"""
+import copy
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+from googleapiclient.errors import HttpError
+from google.cloud.firestore_v1.transforms import DELETE_FIELD, Increment
+
+
+class Latency:
+    """
+    A delay of `seconds`, plus up to `jitter` seconds drawn uniformly.
+    """
+
+    def __init__(self, seconds=0.0, jitter=0.0, sleep=time.sleep):
+        self.seconds = seconds
+        self.jitter = jitter
+        self.sleep = sleep
+
+    def wait(self):
+        delay = self.seconds + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            self.sleep(delay)
+
+
+NO_LATENCY = Latency()
+
+
+# Firestore
+
+def get_field(data, path):
+    for part in path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            raise KeyError(path)
+        data = data[part]
+    return data
+
+
+def set_field(data, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        data = data.setdefault(part, {})
+    if value is DELETE_FIELD:
+        data.pop(parts[-1], None)
+    else:
+        data[parts[-1]] = copy.deepcopy(value)
+
+
+def merge_fields(data, updates):
+    for key, value in updates.items():
+        if isinstance(value, Increment):
+            data[key] = data.get(key, 0) + value.value
+        elif value is DELETE_FIELD:
+            data.pop(key, None)
+        elif isinstance(value, dict):
+            merge_fields(data.setdefault(key, {}), value)
+        else:
+            data[key] = copy.deepcopy(value)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, path):
+        return copy.deepcopy(get_field(self._data or {}, path))
+
+
+class FakeDocument:
+    def __init__(self, db, collection, id):
+        self.db = db
+        self.collection = collection
+        self.id = id
+        self.path = '{}/{}'.format(collection, id)
+
+    def get(self, field_paths=None, transaction=None):
+        self.db.call('document.get')
+        return self.db.read(self.collection, self.id, field_paths)
+
+    def set(self, data, merge=False):
+        self.db.call('document.set')
+        self.db.write(self.collection, self.id, data, merge=merge)
+
+    def update(self, data):
+        self.db.call('document.update')
+        if not self.db.read(self.collection, self.id).exists:
+            raise KeyError('No document to update: {}'.format(self.path))
+        self.db.write(self.collection, self.id, data, merge=True, dotted=True)
+
+    def delete(self):
+        self.db.call('document.delete')
+        self.db.remove(self.collection, self.id)
+
+    def on_snapshot(self, callback):
+        return self.db.watch(self.collection, callback, self.id)
+
+
+OPERATORS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    'in': lambda a, b: a in b,
+    'array_contains': lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+class FakeQuery:
+    def __init__(self, db, collection, filters=(), orders=(), after=None, fields=None, count=None):
+        self.db = db
+        self.collection = collection
+        self._filters = list(filters)
+        self._orders = list(orders)
+        self._after = after
+        self._fields = fields
+        self._count = count
+
+    def _copy(self, **changes):
+        state = dict(filters=self._filters, orders=self._orders, after=self._after, fields=self._fields, count=self._count)
+        state.update(changes)
+        return FakeQuery(self.db, self.collection, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + [(field, OPERATORS[op], value)])
+
+    def order_by(self, field, direction='ASCENDING'):
+        return self._copy(orders=self._orders + [(field, direction == 'DESCENDING')])
+
+    def start_after(self, snapshot):
+        return self._copy(after=snapshot)
+
+    def select(self, fields):
+        return self._copy(fields=list(fields))
+
+    def limit(self, count):
+        return self._copy(count=count)
+
+    def stream(self):
+        self.db.call('query.stream')
+        items = self.db.items(self.collection, lambda data: all(self._matches(data, f) for f in self._filters))
+        for field, descending in reversed(self._orders):
+            items.sort(key=lambda item: self._value(item[1], field), reverse=descending)
+        if self._after is not None:
+            ids = [id for id, _ in items]
+            if self._after.id in ids:
+                items = items[ids.index(self._after.id) + 1:]
+        if self._count is not None:
+            items = items[:self._count]
+        for id, data in items:
+            if self._fields is not None:
+                data = {field: get_field(data, field) for field in self._fields if self._has(data, field)}
+            yield FakeSnapshot(FakeDocument(self.db, self.collection, id), data)
+
+    def get(self):
+        return list(self.stream())
+
+    @staticmethod
+    def _has(data, field):
+        try:
+            get_field(data, field)
+            return True
+        except KeyError:
+            return False
+
+    def _matches(self, data, filter):
+        field, operator, value = filter
+        return self._has(data, field) and operator(get_field(data, field), value)
+
+    def _value(self, data, field):
+        return get_field(data, field) if self._has(data, field) else ''
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(db, name)
+        self.name = name
+
+    def document(self, id=None):
+        return FakeDocument(self.db, self.name, id or next(self.db.ids))
+
+    def on_snapshot(self, callback):
+        return self.db.watch(self.name, callback)
+
+
+Change = namedtuple('Change', ['type', 'document'])
+ChangeType = namedtuple('ChangeType', ['name'])
+
+
+class FakeWatch:
+    def __init__(self, db, collection, callback, document_id=None):
+        self.db = db
+        self.collection = collection
+        self.callback = callback
+        self.document_id = document_id
+
+    def unsubscribe(self):
+        self.db.unwatch(self)
+
+
+class FakeTransaction:
+    """
+    Serialises the transactions of a FakeFirestore. It implements the methods
+    firestore.transactional calls on a transaction.
+    """
+    _read_only = False
+    _max_attempts = 1
+
+    def __init__(self, db):
+        self.db = db
+        self._id = None
+        self._writes = []
+
+    def _clean_up(self):
+        self._writes = []
+
+    def _begin(self, retry_id=None):
+        self.db.transaction_lock.acquire()
+        self._id = next(self.db.ids)
+
+    def _commit(self):
+        self.db.call('transaction.commit')
+        try:
+            for write in self._writes:
+                write()
+        finally:
+            self._end()
+
+    def _rollback(self):
+        self._end()
+
+    def _end(self):
+        self._writes = []
+        if self._id is not None:
+            self._id = None
+            self.db.transaction_lock.release()
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(lambda: self.db.write(reference.collection, reference.id, data, merge=merge))
+
+    def update(self, reference, data):
+        self._writes.append(lambda: self.db.write(reference.collection, reference.id, data, merge=True, dotted=True))
+
+    def delete(self, reference):
+        self._writes.append(lambda: self.db.remove(reference.collection, reference.id))
+
+
+class FakeFirestore:
+    """
+    A Firestore client keeping its documents in memory.
+    """
+
+    def __init__(self, latency=NO_LATENCY):
+        self.latency = latency
+        self.calls = Counter()
+        self.ids = ('fake-{}'.format(i) for i in itertools.count())
+        self.transaction_lock = threading.Lock()
+        self._collections = {}
+        self._watches = []
+        self._lock = threading.RLock()
+
+    def call(self, name):
+        self.calls[name] += 1
+        self.latency.wait()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def get_all(self, references):
+        self.call('get_all')
+        return [self.read(ref.collection, ref.id) for ref in references]
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    def read(self, collection, id, field_paths=None):
+        with self._lock:
+            data = self._collections.get(collection, {}).get(id)
+            if data is not None and field_paths is not None:
+                data = {path: get_field(data, path) for path in field_paths if FakeQuery._has(data, path)}
+            return FakeSnapshot(FakeDocument(self, collection, id), data)
+
+    def items(self, collection, predicate=None):
+        """
+        The (id, data) pairs of a collection. The data must not be changed.
+        """
+        with self._lock:
+            return [(id, data) for id, data in self._collections.get(collection, {}).items()
+                    if predicate is None or predicate(data)]
+
+    def write(self, collection, id, data, merge=False, dotted=False):
+        with self._lock:
+            documents = self._collections.setdefault(collection, {})
+            change = 'MODIFIED' if id in documents else 'ADDED'
+            # Stored documents are never changed in place, so that snapshots
+            # can share them.
+            current = copy.deepcopy(documents.get(id, {})) if merge else {}
+            if dotted:
+                for path, value in data.items():
+                    set_field(current, path, value)
+            else:
+                merge_fields(current, data)
+            documents[id] = current
+        self._notify(collection, id, change)
+
+    def remove(self, collection, id):
+        with self._lock:
+            existed = self._collections.get(collection, {}).pop(id, None) is not None
+        if existed:
+            self._notify(collection, id, 'REMOVED')
+
+    def watch(self, collection, callback, document_id=None):
+        """
+        Call back with the documents of a collection, or a single document,
+        then with every change to them, like on_snapshot.
+        """
+        watch = FakeWatch(self, collection, callback, document_id)
+        with self._lock:
+            self._watches.append(watch)
+            if document_id is None:
+                snapshots = [FakeSnapshot(FakeDocument(self, collection, id), data) for id, data in self.items(collection)]
+            else:
+                snapshots = [self.read(collection, document_id)]
+        callback(snapshots, [Change(ChangeType('ADDED'), snapshot) for snapshot in snapshots], time.time())
+        return watch
+
+    def unwatch(self, watch):
+        with self._lock:
+            self._watches.remove(watch)
+
+    def _notify(self, collection, id, change):
+        with self._lock:
+            watches = [watch for watch in self._watches
+                       if watch.collection == collection and watch.document_id in [None, id]]
+        if not watches:
+            return
+        snapshot = self.read(collection, id)
+        for watch in watches:
+            watch.callback([snapshot], [Change(ChangeType(change), snapshot)], time.time())
+
+    def seed(self, collection, documents):
+        """
+        Store documents directly, without latency, as {id: data}.
+        """
+        with self._lock:
+            self._collections.setdefault(collection, {}).update(copy.deepcopy(documents))
+
+
+class FakeAuth:
+    """
+    Stands for firebase_admin.auth: the ID token is the firebase uid.
+    """
+
+    def __init__(self, latency=NO_LATENCY):
+        self.latency = latency
+
+    def verify_id_token(self, id_token):
+        self.latency.wait()
+        return {'uid': id_token, 'exp': time.time() + 3600}
+
+
+# Compute
+
+class FakeRequest:
+    def __init__(self, compute, name, fn):
+        self.compute = compute
+        self.name = name
+        self.fn = fn
+
+    def execute(self):
+        self.compute.call(self.name)
+        return self.fn()
+
+
+class FakeInstances:
+    def __init__(self, compute):
+        self.compute = compute
+
+    def insert(self, project, zone, body):
+        return FakeRequest(self.compute, 'instances.insert', lambda: self.compute.insert(zone, body))
+
+    def get(self, project, zone, instance):
+        return FakeRequest(self.compute, 'instances.get', lambda: self.compute.get(zone, instance))
+
+    def delete(self, project, zone, instance):
+        return FakeRequest(self.compute, 'instances.delete', lambda: self.compute.delete(zone, instance))
+
+    def setLabels(self, project, zone, instance, body):
+        return FakeRequest(self.compute, 'instances.setLabels', lambda: self.compute.set_labels(zone, instance, body))
+
+    def setMetadata(self, project, zone, instance, body):
+        return FakeRequest(self.compute, 'instances.setMetadata', lambda: self.compute.set_metadata(zone, instance, body))
+
+    def aggregatedList(self, project, filter=None):
+        return FakeRequest(self.compute, 'instances.aggregatedList', lambda: self.compute.aggregated_list(filter))
+
+    def aggregatedList_next(self, previous_request, previous_response):
+        return None
+
+
+class FakeImages:
+    def __init__(self, compute):
+        self.compute = compute
+
+    def list(self, project, filter=None, orderBy=None, maxResults=None):
+        return FakeRequest(self.compute, 'images.list', lambda: {'items': [{'name': self.compute.image}]})
+
+
+class FakeZoneOperations:
+    def __init__(self, compute):
+        self.compute = compute
+
+    def wait(self, project, zone, operation):
+        return FakeRequest(self.compute, 'zoneOperations.wait', lambda: self.compute.operations[operation])
+
+
+class FakeCompute:
+    """
+    A Compute client whose instances live in memory.
+
+    An instance stays in STAGING for `boot_seconds`, plus up to `boot_jitter`
+    seconds, on `clock`, then is
+    RUNNING with an IP, its narupa server being up `narupa_seconds` later.
+    It deletes itself once booted for the duration given in its metadata, as
+    start.sh does. A `failure_rate` share of the instances end TERMINATED
+    right after booting instead. Inserts in the zones of `exhausted_zones`
+    fail for lack of capacity.
+    """
+
+    def __init__(self, latency=NO_LATENCY, boot_seconds=60, boot_jitter=0, narupa_seconds=30, failure_rate=0.0,
+                 exhausted_zones=(), image='narupa-image', clock=time.time, seed=None):
+        self.latency = latency
+        self.boot_seconds = boot_seconds
+        self.boot_jitter = boot_jitter
+        self.narupa_seconds = narupa_seconds
+        self.failure_rate = failure_rate
+        self.exhausted_zones = set(exhausted_zones)
+        self.image = image
+        self.clock = clock
+        self.calls = Counter()
+        self.operations = {}
+        self._instances = {}
+        self._by_ip = {}
+        self._random = random.Random(seed)
+        self._ips = ('10.{}.{}.{}'.format(i // 65536 % 256, i // 256 % 256, i % 256) for i in itertools.count(1))
+        self._lock = threading.Lock()
+
+    def call(self, name):
+        self.calls[name] += 1
+        self.latency.wait()
+
+    def instances(self):
+        return FakeInstances(self)
+
+    def images(self):
+        return FakeImages(self)
+
+    def zoneOperations(self):
+        return FakeZoneOperations(self)
+
+    def insert(self, zone, body):
+        operation = 'operation-{}'.format(body['name'])
+        if zone in self.exhausted_zones:
+            error = {'errors': [{'code': 'ZONE_RESOURCE_POOL_EXHAUSTED'}]}
+            self.operations[operation] = {'name': operation, 'status': 'DONE', 'error': error}
+            return {'name': operation, 'status': 'RUNNING'}
+        items = {item['key']: item['value'] for item in body.get('metadata', {}).get('items', [])}
+        with self._lock:
+            created_at = self.clock()
+            booted_at = created_at + self.boot_seconds + self._random.uniform(0, self.boot_jitter)
+            self._instances[body['name']] = {
+                'body': copy.deepcopy(body),
+                'zone': zone,
+                'created_at': created_at,
+                'booted_at': booted_at,
+                'stops_at': booted_at + int(items['duration']) if 'duration' in items else None,
+                'fails': self._random.random() < self.failure_rate,
+                'ip': None,
+                'deleted': False,
+            }
+        self.operations[operation] = {'name': operation, 'status': 'DONE'}
+        return {'name': operation, 'status': 'RUNNING'}
+
+    def get(self, zone, name):
+        with self._lock:
+            instance = self._instances.get(name)
+            if instance is None or self._deleted(instance):
+                raise not_found(name)
+            return self._resource(name, instance)
+
+    def delete(self, zone, name):
+        with self._lock:
+            if name not in self._instances:
+                raise not_found(name)
+            self._instances[name]['deleted'] = True
+        return {'status': 'RUNNING'}
+
+    def set_labels(self, zone, name, body):
+        with self._lock:
+            labels = self._instances[name]['body'].setdefault('labels', {})
+            labels.clear()
+            labels.update(body['labels'])
+        return {'status': 'DONE'}
+
+    def set_metadata(self, zone, name, body):
+        with self._lock:
+            self._instances[name]['body']['metadata'] = {'items': list(body['items'])}
+        return {'status': 'DONE'}
+
+    def aggregated_list(self, filter=None):
+        items = {}
+        with self._lock:
+            for name, instance in list(self._instances.items()):
+                if self._deleted(instance):
+                    # Deleted instances are forgotten, as they are by Compute.
+                    del self._instances[name]
+                    self._by_ip.pop(instance['ip'], None)
+                    continue
+                scoped = items.setdefault('zones/{}'.format(instance['zone']), {'instances': []})
+                scoped['instances'].append(self._resource(name, instance))
+        return {'items': items}
+
+    def narupa_ready(self, ip):
+        with self._lock:
+            instance = self._by_ip.get(ip)
+            if instance is None or self._deleted(instance):
+                return False
+            return self._status(instance) == 'RUNNING' and self.clock() >= instance['booted_at'] + self.narupa_seconds
+
+    def _deleted(self, instance):
+        if instance['stops_at'] is not None and self.clock() >= instance['stops_at']:
+            instance['deleted'] = True
+        return instance['deleted']
+
+    def _status(self, instance):
+        if self.clock() < instance['booted_at']:
+            return 'STAGING'
+        if instance['fails']:
+            return 'TERMINATED'
+        if instance['ip'] is None:
+            instance['ip'] = next(self._ips)
+            self._by_ip[instance['ip']] = instance
+        return 'RUNNING'
+
+    def _resource(self, name, instance):
+        status = self._status(instance)
+        access = {'name': 'External NAT'}
+        if status == 'RUNNING':
+            access['natIP'] = instance['ip']
+        return {
+            'name': name,
+            'status': status,
+            'zone': 'projects/fake/zones/{}'.format(instance['zone']),
+            'tags': instance['body'].get('tags', {}),
+            'labels': dict(instance['body'].get('labels', {})),
+            'labelFingerprint': 'fingerprint',
+            'metadata': dict(instance['body'].get('metadata', {}), fingerprint='fingerprint'),
+            'networkInterfaces': [{'accessConfigs': [access]}],
+        }
+
+
+def not_found(name):
+    content = json.dumps({'error': {'errors': [{'reason': 'notFound'}], 'message': name}}).encode()
+    return HttpError(httplib2.Response({'status': 404}), content)
+
+
+class FakeProber:
+    """
+    Stands for probe.prober, asking a FakeCompute whether narupa is up.
+    """
+
+    def __init__(self, compute, latency=NO_LATENCY):
+        self.compute = compute
+        self.latency = latency
+        self.calls = 0
+
+    def probe(self, ips):
+        ips = set(ip for ip in ips if ip)
+        if not ips:
+            return {}
+        self.calls += 1
+        self.latency.wait()
+        return {ip: self.compute.narupa_ready(ip) for ip in ips}
+
+    def close(self):
+        pass
+
+
+# HTTP stubs
+
+class StubServer:
+    """
+    A local HTTP server answering the GitLab, Zoom and file requests of the
+    API. Point GITLAB_URL, ZOOM_OAUTH_URL and ZOOM_API_URL at `url` (followed
+    by /zoom/oauth and /zoom/v2 for Zoom) before importing the API.
+
+    `branches` are the GitLab branches that exist, `files` maps paths under
+    /files/ to their content.
+    """
+
+    def __init__(self, latency=NO_LATENCY, branches=('master',), files=None):
+        self.latency = latency
+        self.branches = set(branches)
+        self.files = dict(files or {})
+        self.calls = Counter()
+        self._meeting_ids = itertools.count(1000)
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def handle(self, method, path, query):
+        """
+        Route a request, returning its status and JSON body, or a status and
+        bytes for files, optionally followed by response headers.
+        """
+        self.calls['{} {}'.format(method, re.sub(r'/\d+(?=/|$)', '/*', path))] += 1
+        self.latency.wait()
+
+        listing = re.match(r'^/api/v4/projects/([^/]+)/repository/branches$', path)
+        if listing and method == 'GET':
+            per_page = int(query.get('per_page', ['20'])[0])
+            page = int(query.get('page', ['1'])[0])
+            names = sorted(self.branches)
+            items = [{'name': name} for name in names[(page - 1) * per_page:page * per_page]]
+            headers = {}
+            if page * per_page < len(names):
+                headers['Link'] = '<{}{}?per_page={}&page={}>; rel="next"'.format(self.url, path, per_page, page + 1)
+            return 200, items, headers
+
+        branch = re.match(r'^/api/v4/projects/[^/]+/repository/branches/(.+)$', path)
+        if branch and method == 'GET':
+            name = branch.group(1).replace('%2F', '/')
+            return (200, {'name': name}) if name in self.branches else (404, {'message': '404 Branch Not Found'})
+
+        if path == '/zoom/oauth/token' and method == 'POST':
+            return 200, {'access_token': 'access', 'refresh_token': 'refresh', 'expires_in': 3600}
+        if path == '/zoom/v2/users/me/meetings' and method == 'POST':
+            id = next(self._meeting_ids)
+            return 201, {'id': id, 'join_url': 'https://zoom.example/j/{}'.format(id)}
+        if path.startswith('/zoom/v2/meetings/') and method in ['PATCH', 'DELETE']:
+            return 204, None
+
+        if path.startswith('/files/') and path[len('/files/'):] in self.files:
+            return 200, self.files[path[len('/files/'):]]
+        return 404, {'message': 'Not found'}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self, method):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                status, body, *headers = stub.handle(method, url.path, parse_qs(url.query))
+                if isinstance(body, bytes):
+                    content, content_type = body, 'application/octet-stream'
+                else:
+                    content = b'' if body is None else json.dumps(body).encode()
+                    content_type = 'application/json'
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in (headers[0] if headers else {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if method != 'HEAD' and status != 204:
+                    self.wfile.write(content)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_HEAD(self):
+                self._respond('HEAD')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def do_PATCH(self):
+                self._respond('PATCH')
+
+            def do_DELETE(self):
+                self._respond('DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,209 @@
+"""
+Cost of hydrating a session document and serializing it back, with the
+reflective `to_dict` models and with the compiled slot-based models.
+
+Run from the naas_server directory:
+
+    python benchmarks/models.py --repeat 20000
+
+The script first checks that both implementations serialize every sample
+document to the same dictionary.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from api import classes, utils  # noqa: E402
+
+
+class Snapshot:
+    """
+    Stands for a Firestore document snapshot.
+    """
+
+    def __init__(self, id, data):
+        self.id = id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+# Taken from https://stackoverflow.com/a/1118038
+def to_dict(obj, classkey=None):
+    if isinstance(obj, dict):
+        data = {}
+        for (k, v) in obj.items():
+            data[k] = to_dict(v, classkey)
+        return data
+    elif hasattr(obj, "_ast"):
+        return to_dict(obj._ast())
+    elif hasattr(obj, "__iter__") and not isinstance(obj, str):
+        return [to_dict(v, classkey) for v in obj]
+    elif hasattr(obj, "__dict__"):
+        data = dict([(key, to_dict(value, classkey))
+            for key, value in obj.__dict__.items()
+            if not callable(value) and not key.startswith('_')])
+        if classkey is not None and hasattr(obj, "__class__"):
+            data[classkey] = obj.__class__.__name__
+        return data
+    else:
+        return obj
+
+
+class LegacySession:
+    def __init__(self, data):
+        d = data if utils.is_dict(data) else data.to_dict()
+        self.id = utils.generate_id() if utils.is_dict(data) else data.id
+        self.created_at = d.get('created_at', utils.generate_created_at())
+        self.user_id = d.get('user_id', None)
+        self.description = d.get('description', None)
+        self.warm_up_at = d.get('warm_up_at', None)
+        self.start_at = d.get('start_at', None)
+        self.end_at = d.get('end_at', None)
+        self.end_at_utc = d.get('end_at_utc', None)
+        self.terminate_at = d.get('terminate_at', None)
+        self.timezone = d.get('timezone', None)
+        self.record = d.get('record', False)
+        self.create_conference = d.get('create_conference', False)
+        self.location = d.get('location', None)
+        self.branch = d.get('branch', None)
+        self.instance = LegacyInstance(d['instance']) if d.get('instance', None) is not None else LegacyInstance({'status': 'PENDING'})
+        self.simulation = LegacySimulation(d['simulation']) if d.get('simulation', None) is not None else None
+        self.zoom_meeting = LegacyZoomMeeting(d['zoom_meeting']) if d.get('zoom_meeting', None) is not None else None
+
+    def to_dict(self):
+        return to_dict(self)
+
+
+class LegacySimulation:
+    def __init__(self, data):
+        d = data if utils.is_dict(data) else data.to_dict()
+        # The legacy model gave nested simulations a new id on every load.
+        self.id = d.get('id') if utils.is_dict(data) else data.id
+        self.created_at = d.get('created_at', utils.generate_created_at())
+        self.user_id = d.get('user_id', None)
+        self.name = d.get('name', None)
+        self.description = d.get('description', None)
+        self.author = d.get('author', None)
+        self.citation = d.get('citation', None)
+        self.image_url = d.get('image_url', None)
+        self.runner = d.get('runner', None)
+        self.config_url = d.get('config_url', None)
+        self.topology_url = d.get('topology_url', None)
+        self.trajectory_url = d.get('trajectory_url', None)
+        self.rendering_url = d.get('rendering_url', None)
+        self.public = d.get('public', False)
+        self.machine_profile = d.get('machine_profile', None)
+        self.particle_count = d.get('particle_count', None)
+        self.trajectory_size = d.get('trajectory_size', None)
+
+
+class LegacyZoomMeeting:
+    def __init__(self, data):
+        if data:
+            self.id = data.get('id', None)
+            self.join_url = data.get('join_url', None)
+
+
+class LegacyInstance:
+    def __init__(self, data):
+        if data:
+            self.status = data.get('status', None)
+            self.id = data.get('id', None)
+            self.ip = data.get('ip', None)
+            self.zone = data.get('zone', None)
+            self.machine_profile = data.get('machine_profile', None)
+            self.gpu_count = data.get('gpu_count', None)
+            self.pooled = data.get('pooled', False)
+            self.warming_at = data.get('warming_at', None)
+            self.launched_at = data.get('launched_at', None)
+
+
+SIMULATION = {
+    'id': 'b6c1b2a0-7a53-4a43-9d0e-9a3c2f0e1a11',
+    'created_at': '2020-10-01T10:00:00',
+    'user_id': '0f1d7a60-3b5c-4bb5-8f6b-0d7f6e1f9c22',
+    'name': 'Nanotube methane',
+    'description': 'A methane molecule going through a carbon nanotube.',
+    'author': 'Narupa',
+    'citation': None,
+    'image_url': 'https://example.com/nanotube.png',
+    'runner': 'ase',
+    'config_url': 'https://example.com/nanotube.xml',
+    'topology_url': None,
+    'trajectory_url': None,
+    'rendering_url': None,
+    'public': True,
+}
+
+SAMPLES = [
+    Snapshot('2b8e4f57-3a0c-4d3d-8e47-5f6d2b9c0a33', {
+        'created_at': '2020-10-02T09:00:00',
+        'user_id': '0f1d7a60-3b5c-4bb5-8f6b-0d7f6e1f9c22',
+        'description': 'Teaching session',
+        'warm_up_at': '2020-10-03T13:45:00',
+        'start_at': '2020-10-03T14:00:00',
+        'end_at': '2020-10-03T15:00:00',
+        'end_at_utc': '2020-10-03T14:00:00',
+        'terminate_at': None,
+        'timezone': 'Europe/London',
+        'record': False,
+        'create_conference': True,
+        'location': 'europe-west2',
+        'branch': 'master',
+        'instance': {
+            'status': 'LAUNCHED', 'id': 'narupa-simulation-abcdef', 'ip': '203.0.113.7', 'zone': 'europe-west2-b',
+            'machine_profile': 'gpu', 'gpu_count': 1, 'pooled': True,
+            'warming_at': '2020-10-03T13:44:00', 'launched_at': '2020-10-03T13:47:30',
+        },
+        'simulation': SIMULATION,
+        'zoom_meeting': {'id': 123456789, 'join_url': 'https://zoom.us/j/123456789'},
+    }),
+    Snapshot('7d0a5c2e-91f4-4f0e-b8a2-1c3e5d7f9b44', {
+        'created_at': '2020-10-02T09:00:00',
+        'start_at': '2020-10-03T14:00:00',
+        'end_at': '2020-10-03T15:00:00',
+        'timezone': 'UTC',
+        'instance': {},
+        'simulation': SIMULATION,
+    }),
+]
+
+
+def check_output():
+    for snapshot in SAMPLES:
+        legacy = LegacySession(snapshot).to_dict()
+        compiled = classes.Session(snapshot).to_dict()
+        if legacy != compiled or list(legacy) != list(compiled):
+            raise AssertionError('Serialized sessions differ for {}:\n{}\n{}'.format(snapshot.id, legacy, compiled))
+
+
+def report(name, seconds, repeat):
+    print('{:<10} {:>8.2f} us/session'.format(name, seconds / repeat / len(SAMPLES) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=20000)
+    args = parser.parse_args()
+
+    check_output()
+
+    def legacy():
+        for snapshot in SAMPLES:
+            LegacySession(snapshot).to_dict()
+
+    def compiled():
+        for snapshot in SAMPLES:
+            classes.Session(snapshot).to_dict()
+
+    report('legacy', timeit.timeit(legacy, number=args.repeat), args.repeat)
+    report('compiled', timeit.timeit(compiled, number=args.repeat), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
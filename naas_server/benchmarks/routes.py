@@ -0,0 +1,142 @@
+"""
+Latency of the main API routes, against in-process fakes of Firestore,
+Compute, GitLab and Zoom.
+
+Run from the naas_server directory:
+
+    python benchmarks/routes.py --repeat 200 --sessions 2000 --firestore-latency 0.002
+
+Each route is called --repeat times through the Flask test client. The
+latencies injected in the fakes stand for the network round trips, so that
+changes in the number of calls per request show up in the timings.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+
+USER_ID = 'bench-user'
+FIREBASE_UID = 'bench-uid'
+SIMULATION_ID = 'bench-simulation'
+SYSTEM_XML = b'<System>\n' + b'<Particle mass="1"/>\n' * 5000 + b'</System>\n'
+
+
+def seed(db, stub_url, sessions, simulations):
+    db.seed('users', {USER_ID: {
+        'name': 'Benchmark',
+        'firebase_uid': FIREBASE_UID,
+        'can_view_stats': True,
+    }})
+    db.seed('simulations', {
+        '{}-{}'.format(SIMULATION_ID, i) if i else SIMULATION_ID: {
+            'name': 'Simulation {}'.format(i),
+            'user_id': USER_ID if i % 2 else 'someone-else',
+            'runner': 'omm',
+            'config_url': '{}/files/system.xml'.format(stub_url),
+            'public': i % 3 == 0,
+        } for i in range(simulations)
+    })
+    start = datetime(2030, 1, 1)
+    db.seed('sessions', {
+        'bench-session-{}'.format(i): {
+            'user_id': USER_ID,
+            'start_at': (start + timedelta(hours=i)).isoformat(),
+            'end_at': (start + timedelta(hours=i + 1)).isoformat(),
+            'end_at_utc': (start + timedelta(hours=i + 1)).isoformat(),
+            'warm_up_at': (start + timedelta(hours=i, minutes=-15)).isoformat(),
+            'timezone': 'UTC',
+            'location': 'europe-west2',
+            'branch': 'master',
+            'instance': {'status': 'PENDING'},
+            'simulation': {'id': SIMULATION_ID, 'name': 'Simulation 0', 'runner': 'omm'},
+        } for i in range(sessions)
+    })
+
+
+def session_body(i):
+    start = datetime(2031, 1, 1) + timedelta(hours=i)
+    return {
+        'description': 'Benchmark session',
+        'start_at': start.isoformat(),
+        'end_at': (start + timedelta(hours=1)).isoformat(),
+        'timezone': 'UTC',
+        'location': 'europe-west2',
+        'branch': 'master',
+        'create_conference': False,
+        'simulation': {'id': SIMULATION_ID},
+    }
+
+
+def measure(name, call, repeat):
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        response = call(i)
+        durations.append(time.perf_counter() - start)
+        if response.status_code >= 300:
+            raise RuntimeError('{} answered {}: {}'.format(name, response.status_code, response.get_data(as_text=True)))
+    durations.sort()
+    print('{:<28} mean {:>8.2f} ms   p50 {:>8.2f} ms   p95 {:>8.2f} ms'.format(
+        name,
+        statistics.mean(durations) * 1000,
+        durations[len(durations) // 2] * 1000,
+        durations[int(len(durations) * 0.95)] * 1000,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=1000, help='sessions of the benchmark user')
+    parser.add_argument('--simulations', type=int, default=200)
+    parser.add_argument('--firestore-latency', type=float, default=0.0, help='seconds per Firestore call')
+    parser.add_argument('--compute-latency', type=float, default=0.0, help='seconds per Compute call')
+    parser.add_argument('--http-latency', type=float, default=0.0, help='seconds per GitLab, Zoom or file request')
+    args = parser.parse_args()
+
+    stub = fakes.StubServer(fakes.Latency(args.http_latency), branches=['master'] + ['feature-{}'.format(i) for i in range(250)], files={'system.xml': SYSTEM_XML})
+    os.environ['GITLAB_URL'] = stub.url
+    os.environ['ZOOM_OAUTH_URL'] = stub.url + '/zoom/oauth'
+    os.environ['ZOOM_API_URL'] = stub.url + '/zoom/v2'
+
+    from api import create_app, gcp, probe
+
+    db = fakes.FakeFirestore(fakes.Latency(args.firestore_latency))
+    compute = fakes.FakeCompute(fakes.Latency(args.compute_latency))
+    gcp.use_compute_client(compute)
+    probe.prober = fakes.FakeProber(compute)
+    seed(db, stub.url, args.sessions, args.simulations)
+
+    app = create_app(db, fakes.FakeAuth())
+    client = app.test_client()
+    headers = {'x-narupa-id-token': FIREBASE_UID}
+
+    measure('GET /api/sessions', lambda i: client.get('/api/sessions', headers=headers), args.repeat)
+    measure('GET /api/sessions?fields', lambda i: client.get(
+        '/api/sessions?fields=start_at,end_at,instance', headers=headers), args.repeat)
+    measure('POST /api/sessions', lambda i: client.post('/api/sessions', json=session_body(i), headers=headers), args.repeat)
+    measure('PUT /api/sessions/<id>', lambda i: client.put(
+        '/api/sessions/bench-session-{}'.format(i % args.sessions), json=session_body(i), headers=headers), args.repeat)
+    measure('GET /api/branches', lambda i: client.get('/api/branches', headers=headers), args.repeat)
+    measure('GET /api/simulations', lambda i: client.get('/api/simulations', headers=headers), args.repeat)
+    measure('POST /api/simulations', lambda i: client.post('/api/simulations', json={
+        'name': 'New simulation {}'.format(i),
+        'runner': 'omm',
+        'config_url': '{}/files/system.xml'.format(stub.url),
+    }, headers=headers), args.repeat)
+
+    print()
+    print('Firestore calls: {}'.format(dict(db.calls)))
+    print('HTTP stub calls: {}'.format(dict(stub.calls)))
+    stub.close()
+
+
+if __name__ == '__main__':
+    main()
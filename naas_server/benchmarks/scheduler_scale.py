@@ -0,0 +1,178 @@
+"""
+Discrete-event simulation of the session scheduler with thousands of booked
+sessions, on a virtual clock, against the fake Firestore and Compute.
+
+Run from the naas_server directory:
+
+    python benchmarks/scheduler_scale.py --sessions 5000 --days 14 --hours 24
+
+Sessions are booked over --days days. They start on the hour or half hour,
+mostly in working hours, and last 30 minutes to 5 hours. The first --hours
+hours are simulated: the simulation jumps from one scheduler deadline to the
+next, and reconciles every --reconcile-minutes like the cron job does, every
+booked session being read by each reconciliation.
+It reports, per batch of the scheduler, the real time spent and the calls
+made to the fakes, then how long after their start_at sessions got
+LAUNCHED. No network access is needed.
+"""
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+from api import gcp, probe, utils  # noqa: E402
+from api import scheduler as session_scheduler  # noqa: E402
+
+EPOCH = datetime(2030, 1, 7)
+REGIONS = ['europe-west2', 'us-east1', 'us-west1', 'asia-east1']
+DURATIONS = [30, 60, 90, 120, 180, 240, 300]
+DURATION_WEIGHTS = [10, 30, 15, 25, 10, 6, 4]
+HOUR_WEIGHTS = [1, 1, 1, 1, 1, 1, 2, 4, 8, 12, 14, 12, 8, 12, 14, 12, 10, 6, 4, 3, 2, 2, 1, 1]
+
+
+class VirtualClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class CountingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.counts = Counter()
+
+    def emit(self, record):
+        self.counts[record.levelname] += 1
+
+
+def generate_sessions(count, days, rng):
+    sessions = {}
+    for i in range(count):
+        start = EPOCH + timedelta(days=rng.randrange(days),
+                                  hours=rng.choices(range(24), HOUR_WEIGHTS)[0],
+                                  minutes=rng.choice([0, 30]))
+        end = start + timedelta(minutes=rng.choices(DURATIONS, DURATION_WEIGHTS)[0])
+        sessions['session-{}'.format(i)] = {
+            'user_id': 'user-{}'.format(rng.randrange(count // 10 + 1)),
+            'start_at': start.isoformat(),
+            'end_at': end.isoformat(),
+            'warm_up_at': (start - timedelta(seconds=utils.DEFAULT_WARM_UP_LEAD)).isoformat(),
+            'timezone': 'UTC',
+            'location': rng.choice(REGIONS),
+            'branch': 'master',
+            'instance': {'status': 'PENDING'},
+            'simulation': {'id': 'simulation', 'name': 'Simulation', 'runner': 'omm', 'config_url': 'https://example.org/system.xml'},
+        }
+    return sessions
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return 'n/a'
+    return 'mean {:>8.1f}   p50 {:>8.1f}   p95 {:>8.1f}   max {:>8.1f}'.format(
+        statistics.mean(values), values[len(values) // 2], values[int(len(values) * 0.95)], values[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=14, help='days over which sessions are booked')
+    parser.add_argument('--hours', type=float, default=24, help='hours to simulate')
+    parser.add_argument('--boot-seconds', type=float, default=90)
+    parser.add_argument('--boot-jitter', type=float, default=120)
+    parser.add_argument('--narupa-seconds', type=float, default=30)
+    parser.add_argument('--failure-rate', type=float, default=0.02)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--reconcile-minutes', type=int, default=15)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    clock = VirtualClock(utils.to_timestamp(EPOCH.isoformat(), 'UTC') - 3600)
+    db = fakes.FakeFirestore()
+    compute = fakes.FakeCompute(boot_seconds=args.boot_seconds, boot_jitter=args.boot_jitter,
+                                narupa_seconds=args.narupa_seconds, failure_rate=args.failure_rate,
+                                clock=clock, seed=args.seed)
+    prober = fakes.FakeProber(compute)
+    gcp.use_compute_client(compute)
+    probe.prober = prober
+
+    sessions = generate_sessions(args.sessions, args.days, rng)
+    db.seed('sessions', sessions)
+    end = max(utils.to_timestamp(session['end_at'], 'UTC') for session in sessions.values()) + 3600
+    end = min(end, clock.now + args.hours * 3600)
+
+    logger = logging.getLogger('scheduler-scale')
+    logger.propagate = False
+    handler = CountingHandler()
+    logger.addHandler(handler)
+    # The deadline of a batch is in real time; the simulation never defers.
+    narupa = session_scheduler.NarupaScheduler(db, logger, 'bench', args.concurrency, 3600, clock=clock)
+
+    batches = defaultdict(list)
+    next_reconcile = clock.now
+    started = time.perf_counter()
+    while clock.now <= end:
+        due = narupa.deadlines.next_due()
+        clock.now = max(clock.now, min(next_reconcile, due if due is not None else next_reconcile))
+        compute_calls = sum(compute.calls.values())
+        firestore_calls = sum(db.calls.values())
+        probes = prober.calls
+        queued = len(narupa.deadlines)
+
+        batch_started = time.perf_counter()
+        if clock.now >= next_reconcile:
+            kind = 'reconcile'
+            narupa.tick()
+            next_reconcile += args.reconcile_minutes * 60
+        else:
+            kind = 'deadline'
+            narupa.run_due()
+        batches[kind].append({
+            'seconds': time.perf_counter() - batch_started,
+            'compute': sum(compute.calls.values()) - compute_calls,
+            'firestore': sum(db.calls.values()) - firestore_calls,
+            'probes': prober.calls - probes,
+            'queued': queued,
+        })
+    elapsed = time.perf_counter() - started
+
+    final = {id: data for id, data in db.items('sessions')}
+    statuses = Counter(data['instance']['status'] for data in final.values())
+    lateness = [
+        (utils.to_timestamp(data['instance']['launched_at'], 'UTC') - utils.to_timestamp(data['start_at'], data['timezone'])) / 60
+        for data in final.values() if data['instance'].get('launched_at')
+    ]
+
+    print('{} sessions over {} days, {} hours simulated in {:.1f} s'.format(args.sessions, args.days, args.hours, elapsed))
+    print('Final statuses: {}'.format(dict(statuses)))
+    print()
+    for kind, items in sorted(batches.items()):
+        print('{} batches: {}'.format(kind, len(items)))
+        print('  duration (ms)        {}'.format(percentiles([item['seconds'] * 1000 for item in items])))
+        print('  compute calls        {}'.format(percentiles([item['compute'] for item in items])))
+        print('  firestore calls      {}'.format(percentiles([item['firestore'] for item in items])))
+        print('  status probes        {}'.format(percentiles([item['probes'] for item in items])))
+        print('  queued sessions      {}'.format(percentiles([item['queued'] for item in items])))
+    print()
+    print('LAUNCHED minus start_at (min) {}'.format(percentiles(lateness)))
+    print('Launched after start_at: {} of {}'.format(sum(1 for minutes in lateness if minutes > 0), len(lateness)))
+    print('Compute calls: {}'.format(dict(compute.calls)))
+    print('Firestore calls: {}'.format(dict(db.calls)))
+    print('Scheduler log records: {}'.format(dict(handler.counts)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+from api import classes, profiles  # noqa: E402
+
+LARGE_TRAJECTORY = profiles.LARGE_TRAJECTORY_BYTES + 1
+LARGE_SYSTEM = profiles.LARGE_SYSTEM_PARTICLES + 1
+
+
+def simulation(**fields):
+    return classes.Simulation.from_dict(fields, 'simulation')
+
+
+@pytest.mark.parametrize('fields, expected', [
+    ({'runner': 'static'}, 'viewer'),
+    ({'runner': 'static', 'particle_count': LARGE_SYSTEM}, 'viewer'),
+    ({'runner': 'trajectory'}, 'viewer'),
+    ({'runner': 'trajectory', 'trajectory_size': profiles.LARGE_TRAJECTORY_BYTES}, 'viewer'),
+    ({'runner': 'trajectory', 'trajectory_size': LARGE_TRAJECTORY}, 'viewer-large-disk'),
+    ({'runner': 'static', 'trajectory_size': LARGE_TRAJECTORY}, 'viewer-large-disk'),
+    ({'runner': 'ase'}, 'gpu'),
+    ({'runner': 'ase', 'particle_count': profiles.LARGE_SYSTEM_PARTICLES}, 'gpu'),
+    ({'runner': 'ase', 'particle_count': LARGE_SYSTEM}, 'gpu-large'),
+    ({'runner': 'omm', 'particle_count': 100}, 'gpu'),
+    ({'runner': 'omm', 'particle_count': LARGE_SYSTEM}, 'gpu-large'),
+    ({'runner': 'omm', 'particle_count': LARGE_SYSTEM, 'machine_profile': 'gpu'}, 'gpu'),
+    ({'runner': 'trajectory', 'machine_profile': 'gpu-large'}, 'gpu-large'),
+    ({'runner': 'omm', 'machine_profile': 'unknown'}, 'gpu'),
+    ({}, 'gpu'),
+])
+def test_resolve(fields, expected):
+    assert profiles.resolve(simulation(**fields)).name == expected
+
+
+def test_resolve_without_simulation():
+    assert profiles.resolve(None).name == profiles.DEFAULT_PROFILE
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://8.8.8.8/system.xml', True),
+    ('http://8.8.8.8:8080/system.xml', True),
+    ('ftp://8.8.8.8/system.xml', False),
+    ('file:///etc/passwd', False),
+    ('http://127.0.0.1:5000/api/status', False),
+    ('http://10.0.0.2/system.xml', False),
+    ('http://169.254.169.254/computeMetadata/v1/', False),
+    ('http://[::1]/system.xml', False),
+    ('system.xml', False),
+])
+def test_is_public_url(url, expected):
+    assert profiles.is_public_url(url) == expected
@@ -42,5 +42,16 @@ gcloud compute instances stop $image_name
 # echo "Creating image"
 gcloud compute images create $image_name --source-disk=$image_name  --source-disk-zone=$zone
 
+# Publish the image under IMAGE_TAG, such as 'uselive', if given, and let the
+# API pick it at once rather than when its image cache expires, if given its
+# URL and IMAGE_CACHE_SECRET.
+if [ -n "$IMAGE_TAG" ]; then
+	gcloud compute images add-labels $image_name --labels=$IMAGE_TAG=true
+fi
+if [ -n "$NARUPA_API_URL" ] && [ -n "$IMAGE_CACHE_SECRET" ]; then
+	curl -sf -X DELETE "$NARUPA_API_URL/test/images/cache" -H "x-narupa-image-cache-secret: $IMAGE_CACHE_SECRET" \
+		|| echo "Unable to clear the image cache of the API"
+fi
+
 # echo "Deleting instance"
 gcloud compute instances delete $image_name --delete-disks=all --quiet --zone=$zone
@@ -1,19 +1,90 @@
+import atexit
+import json
+import signal
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
 from flask import Flask
 from narupa.trajectory.frame_client import FrameClient
 from narupa.protocol.command import GetCommandsRequest
 import grpc
 
+METADATA_URL = 'http://metadata.google.internal/computeMetadata/v1/instance/'
+READY_POLL_INTERVAL = 2
+
 
 app = Flask(__name__)
 
 @app.route('/api/status')
 def get_status():
+    return { 'status': is_narupa_ready() }
+
+
+def is_narupa_ready():
     channel = FrameClient.insecure_channel(address='127.0.0.1', port=38801)
     request = GetCommandsRequest()
     try:
         channel._command_stub.GetCommands(request, timeout=1)
     except (grpc._channel._Rendezvous, grpc._channel._InactiveRpcError):
-        return { 'status': False }
+        return False
     finally:
         channel.close()
-    return { 'status': True }
+    return True
+
+
+def get_metadata(path):
+    request = urllib.request.Request(METADATA_URL + path, headers={'Metadata-Flavor': 'Google'})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.read().decode()
+    except urllib.error.URLError:
+        return None
+
+
+def post_callback(status):
+    """
+    Tell the web API that the narupa server is ready or stopped.
+    """
+    url = get_metadata('attributes/callback_url')
+    token = get_metadata('attributes/callback_token')
+    if not url or not token:
+        return
+    body = json.dumps({
+        'status': status,
+        'token': token,
+        'instance': get_metadata('name'),
+        'ip': get_metadata('network-interfaces/0/access-configs/0/external-ip'),
+    }).encode()
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'}, method='POST')
+    try:
+        urllib.request.urlopen(request, timeout=10).close()
+    except urllib.error.URLError as e:
+        print('Unable to post the {} callback: {}'.format(status, e), file=sys.stderr)
+
+
+def report_when_ready():
+    while not is_narupa_ready():
+        time.sleep(READY_POLL_INTERVAL)
+    post_callback('ready')
+
+
+def report_stopped(*args):
+    if not stopped_reported.is_set():
+        stopped_reported.set()
+        post_callback('stopped')
+    if args:
+        sys.exit(0)
+
+
+stopped_reported = threading.Event()
+
+
+threading.Thread(target=report_when_ready, daemon=True).start()
+atexit.register(report_stopped)
+try:
+    signal.signal(signal.SIGTERM, report_stopped)
+except ValueError:
+    # Signal handlers can only be set from the main thread.
+    pass
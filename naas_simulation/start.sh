@@ -4,6 +4,29 @@ function get_metadata() {
     curl "http://metadata.google.internal/computeMetadata/v1/instance/attributes/$1" -H 'Metadata-Flavor: Google'
 }
 
+function has_metadata() {
+    curl -sf "http://metadata.google.internal/computeMetadata/v1/instance/attributes/$1" -H 'Metadata-Flavor: Google' > /dev/null
+}
+
+function wait_for_metadata_change() {
+    curl -s "http://metadata.google.internal/computeMetadata/v1/instance/attributes/?recursive=true&wait_for_change=true&timeout_sec=$1" -H 'Metadata-Flavor: Google' > /dev/null
+}
+
+# Get the lastest narupa of a branch. Master branch is installed on the base image
+function update_narupa() {
+    local narupa_protocol_git="https://gitlab.com/intangiblerealities/narupa-protocol.git"
+    local narupa_protocol_git_dir="narupa-protocol"
+    local remote_commit=$(git ls-remote $narupa_protocol_git | grep refs/heads/$1 | cut -f 1)
+    local local_commit=$(git -C $narupa_protocol_git_dir rev-parse HEAD)
+    if [ "$local_commit" != "$remote_commit" ]; then
+      rm -rf $narupa_protocol_git_dir
+      git clone $narupa_protocol_git --branch $1 $narupa_protocol_git_dir
+      cd $narupa_protocol_git_dir
+      ./compile.sh
+      cd ..
+    fi
+}
+
 function terminate() {
     NAME=$(curl http://metadata.google.internal/computeMetadata/v1/instance/name -H 'Metadata-Flavor: Google')
     ZONE=$(curl http://metadata.google.internal/computeMetadata/v1/instance/zone -H 'Metadata-Flavor: Google')
@@ -17,6 +40,23 @@ source $HOME/.bashrc
 PYTHON=$MINICONDA_PATH/bin/python
 export PATH=$MINICONDA_PATH/bin:$PATH
 
+# Instances of the warm pool boot without a session. They build the branch
+# most sessions run, then wait for the scheduler to claim the instance, which
+# sets the runner and the rest of the session, for at most pool_max_idle
+# seconds.
+if [ "$(get_metadata pool)" == "true" ]; then
+    update_narupa $(get_metadata pool_branch)
+    idle_until=$(( $(date +%s) + $(get_metadata pool_max_idle) ))
+    until has_metadata runner; do
+        now=$(date +%s)
+        if [ $now -ge $idle_until ]; then
+            terminate
+            exit
+        fi
+        wait_for_metadata_change $(( idle_until - now ))
+    done
+fi
+
 # Limit the lifetime of the instance. Terminate the instance at the requested
 # end time if it did not terminate before.
 # We allow a few minutes of grace period for a better user experience.
@@ -25,19 +65,9 @@ timezone=$(get_metadata timezone)
 duration=$($PYTHON ./minutes_until.py ${end_time} ${timezone} 3)
 (sleep $duration; terminate)&
 
-# Get the lastest narupa. Master branch is installed on the base image
-narupa_protocol_git="https://gitlab.com/intangiblerealities/narupa-protocol.git"
-narupa_protocol_git_dir="narupa-protocol"
-branch=$(get_metadata branch)
-remote_commit=$(git ls-remote $narupa_protocol_git | grep refs/heads/$branch | cut -f 1)
-local_commit=$(git -C $narupa_protocol_git_dir rev-parse HEAD)
-if [ "$local_commit" != "$remote_commit" ]; then
-  rm -rf $narupa_protocol_git_dir
-  git clone $narupa_protocol_git --branch $branch $narupa_protocol_git_dir
-  cd $narupa_protocol_git_dir
-  ./compile.sh
-  cd ..
-fi
+# Get the branch of the session, already built on pool instances claimed for
+# the pool branch.
+update_narupa $(get_metadata branch)
 
 # Start the http helper server
 (FLASK_APP=simulation_server.py $PYTHON -m flask run --host=0.0.0.0)&